@@ -0,0 +1,110 @@
+import os
+import glob
+import uuid
+import pickle
+import hashlib
+
+import pandas as pd
+
+
+class CsvCache():
+    # Columnar on-disk cache of parsed CSV inputs. An entry is keyed by the input path,
+    # the reader and its arguments, and stays valid while the input's size and
+    # modification time (and optionally its content hash) are unchanged.
+    # The least recently used entries are evicted beyond max_bytes.
+    def __init__(self, cache_dir, max_bytes=20 * 2 ** 30, hash_content=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _input_files(self, path):
+        if os.path.isdir(path):
+            return sorted(os.path.join(path, i) for i in os.listdir(path)
+                          if os.path.isfile(os.path.join(path, i)))
+        return [path]
+
+    def _fingerprint(self, path):
+        fingerprint = hashlib.sha1()
+        for file_path in self._input_files(path):
+            stat = os.stat(file_path)
+            fingerprint.update(f"{file_path}|{stat.st_size}|{stat.st_mtime_ns}".encode("utf-8"))
+            if self.hash_content:
+                with open(file_path, "rb") as f:
+                    for block in iter(lambda: f.read(2 ** 20), b""):
+                        fingerprint.update(block)
+        return fingerprint.hexdigest()[:16]
+
+    def _key(self, path, reader, kwargs):
+        reader_name = f"{getattr(reader, '__module__', '')}.{getattr(reader, '__name__', repr(reader))}"
+        key = f"{os.path.abspath(path)}|{reader_name}|{sorted(kwargs.items())}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    def read(self, path, reader=pd.read_csv, **kwargs):
+        key = self._key(path, reader, kwargs)
+        fingerprint = self._fingerprint(path)
+        for cached_file in glob.glob(os.path.join(self.cache_dir, f"{key}-*")):
+            if cached_file.endswith(".tmp"):
+                # Being written by another reader
+                continue
+            if os.path.basename(cached_file).startswith(f"{key}-{fingerprint}."):
+                try:
+                    # Mark as recently used for eviction
+                    os.utime(cached_file)
+                    if cached_file.endswith(".parquet"):
+                        return pd.read_parquet(cached_file)
+                    with open(cached_file, "rb") as f:
+                        return pickle.load(f)
+                except FileNotFoundError:
+                    # Evicted by another reader meanwhile: read the input again
+                    break
+            # The input changed since this entry was written
+            try:
+                os.remove(cached_file)
+            except FileNotFoundError:
+                pass
+
+        data = reader(path, **kwargs)
+        self._write(data, os.path.join(self.cache_dir, f"{key}-{fingerprint}"))
+        self.evict()
+        return data
+
+    def _write(self, data, cache_file):
+        # Unique temporary file, as other readers can write the same entry at the same time
+        temporary_file = f"{cache_file}.{uuid.uuid4().hex}.tmp"
+        try:
+            data.to_parquet(temporary_file)
+            os.replace(temporary_file, cache_file + ".parquet")
+        except (ValueError, TypeError, ImportError):
+            # Frames parquet cannot store (e.g. non-string column names) are pickled instead
+            with open(temporary_file, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_file, cache_file + ".pkl")
+
+    def evict(self):
+        # Entries can be removed meanwhile by another reader of the same cache
+        entries = []
+        for entry in os.listdir(self.cache_dir):
+            if entry.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, entry))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(self.cache_dir, entry)))
+        entries.sort(reverse=True)
+        total_bytes = 0
+        for _, size, entry in entries:
+            total_bytes += size
+            if total_bytes > self.max_bytes:
+                try:
+                    os.remove(entry)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        for entry in os.listdir(self.cache_dir):
+            try:
+                os.remove(os.path.join(self.cache_dir, entry))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,55 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# A parsed frame takes a few times the size of its CSV in memory
+MEMORY_PER_INPUT_BYTE = 3
+
+
+def input_bytes(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, i)) for i in os.listdir(path)
+                   if os.path.isfile(os.path.join(path, i)))
+    return os.path.getsize(path)
+
+
+def _timed_read(path, reader):
+    start = time.perf_counter()
+    data = reader(path)
+    return data, time.perf_counter() - start
+
+
+def load_files(loads, max_workers=4, memory_budget=8 * 2 ** 30):
+    # Read independent files concurrently. `loads` is a list of (path, reader); a file is
+    # only started while the estimated memory of the files being read stays within
+    # memory_budget (one file is always allowed, however large). The CSV parser releases
+    # the GIL, so threads overlap both the disk reads and the parsing.
+    # Returns {(path, reader): frame} and the load time of every file.
+    pending = deque((path, reader, input_bytes(path) * MEMORY_PER_INPUT_BYTE) for path, reader in loads)
+    loaded = {}
+    load_times = []
+    in_flight = {}
+    reserved_bytes = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_workers and \
+                    (not in_flight or reserved_bytes + pending[0][2] <= memory_budget):
+                path, reader, estimated_bytes = pending.popleft()
+                in_flight[executor.submit(_timed_read, path, reader)] = (path, reader, estimated_bytes)
+                reserved_bytes += estimated_bytes
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, reader, estimated_bytes = in_flight.pop(future)
+                reserved_bytes -= estimated_bytes
+                data, seconds = future.result()
+                loaded[(path, reader)] = data
+                load_times.append({"path": path, "seconds": seconds, "rows": len(data),
+                                   "input_bytes": estimated_bytes // MEMORY_PER_INPUT_BYTE})
+    return loaded, load_times
+
+
+def print_load_times(load_times):
+    print("Load times:")
+    for load_time in sorted(load_times, key=lambda i: i["seconds"], reverse=True):
+        print(f"{load_time['seconds']:8.2f}s {load_time['rows']:>10} rows  {load_time['path']}")
@@ -0,0 +1,102 @@
+import os
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from aggregation_partitions import member_partitions
+from aggregation_schema import column_group
+
+# Written by write_parquet next to the files of a dataset partitioned by column group
+GROUPS_MANIFEST = "columnGroups.json"
+
+
+def _dense(data):
+    # Parquet has no sparse columns
+    sparse_columns = [column for column in data.columns if isinstance(data[column].dtype, pd.SparseDtype)]
+    if not sparse_columns:
+        return data
+    return data.assign(**{column: data[column].sparse.to_dense() for column in sparse_columns})
+
+
+def write_parquet(data, output_path, partition_by=None, n_buckets=16, compression="zstd",
+                  row_group_size=100000):
+    # partition_by:
+    #   None: a single file
+    #   "column_group": a directory with one file per column group of aggregation_schema
+    #       (each with MEMBER_SK) and a manifest of the columns in every file
+    #   "member_bucket": a directory of MEMBER_SK hash buckets, bucket=N/part-0.parquet
+    # pyarrow is only needed for Parquet output, so it is imported here
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table_options = {"compression": compression, "row_group_size": row_group_size}
+    data = _dense(data)
+    if partition_by is None:
+        pq.write_table(pa.Table.from_pandas(data, preserve_index=False), output_path, **table_options)
+    elif partition_by == "column_group":
+        os.makedirs(output_path, exist_ok=True)
+        groups = {}
+        for column in data.columns:
+            if column != "MEMBER_SK":
+                groups.setdefault(column_group(column)[0], []).append(column)
+        manifest = {}
+        for group, columns in groups.items():
+            file_name = f"{group}.parquet"
+            pq.write_table(pa.Table.from_pandas(data[["MEMBER_SK"] + columns], preserve_index=False),
+                           os.path.join(output_path, file_name), **table_options)
+            manifest[file_name] = columns
+        with open(os.path.join(output_path, GROUPS_MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+    elif partition_by == "member_bucket":
+        buckets = member_partitions(data["MEMBER_SK"], n_buckets)
+        for bucket in range(n_buckets):
+            bucket_path = os.path.join(output_path, f"bucket={bucket}")
+            os.makedirs(bucket_path, exist_ok=True)
+            pq.write_table(pa.Table.from_pandas(data[buckets == bucket], preserve_index=False),
+                           os.path.join(bucket_path, "part-0.parquet"), **table_options)
+    else:
+        raise NotImplementedError(f"BASEHEALTH: partitioning by {partition_by} is not supported")
+    return output_path
+
+
+def read_aggregate_data(input_path, columns=None):
+    # Read aggregated data written as CSV or by write_parquet, only loading `columns`
+    # (and MEMBER_SK) when given: other Parquet columns and column group files are not read
+    if input_path.endswith(".csv"):
+        return pd.read_csv(input_path, index_col=0,
+                           usecols=None if columns is None else lambda i: i in ["MEMBER_SK", "Unnamed: 0"] + columns)
+    selected = None if columns is None else ["MEMBER_SK"] + [i for i in columns if i != "MEMBER_SK"]
+    manifest_path = os.path.join(input_path, GROUPS_MANIFEST)
+    if os.path.isdir(input_path) and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        data = None
+        for file_name, file_columns in manifest.items():
+            file_columns = file_columns if selected is None else [i for i in file_columns if i in selected]
+            if not file_columns and data is not None:
+                continue
+            group_data = pd.read_parquet(os.path.join(input_path, file_name), columns=["MEMBER_SK"] + file_columns)
+            data = group_data if data is None else data.merge(group_data, on="MEMBER_SK", how="outer", sort=False)
+        return data if selected is None else data[[i for i in selected if i in data.columns]]
+    if os.path.isdir(input_path):
+        data = pd.read_parquet(input_path, columns=selected)
+        return data.drop(columns="bucket", errors="ignore")
+    return pd.read_parquet(input_path, columns=selected)
+
+
+def write_csv_threaded(data, output_path, chunksize=100000, workers=4, **to_csv_kwargs):
+    # Same file as data.to_csv(output_path), with chunks of rows formatted in a thread
+    # pool while the formatted chunks are written in order; at most 2 * workers
+    # formatted chunks are held in memory
+    def format_chunk(start):
+        return data.iloc[start:start + chunksize].to_csv(header=start == 0, **to_csv_kwargs)
+
+    starts = deque(range(0, max(len(data), 1), chunksize))
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(output_path, "w", newline="") as f:
+        pending = deque()
+        while starts or pending:
+            while starts and len(pending) < 2 * workers:
+                pending.append(executor.submit(format_chunk, starts.popleft()))
+            f.write(pending.popleft().result())
+    return output_path
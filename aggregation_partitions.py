@@ -0,0 +1,167 @@
+import os
+import shutil
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from aggregation_schema import compact_frame
+
+# Out-of-core aggregation: every input with a MEMBER_SK column is split into
+# n_partitions buckets by a hash of MEMBER_SK, keeping the layout of the input
+# directories in every bucket, so that a bucket holds all the rows of its members
+# and can be aggregated on its own by AggregateAllDataInit. Inputs without
+# MEMBER_SK (e.g. disease statistics) are linked into every bucket.
+
+PARTITION_ROOTS = ("client", "analysis", "rawRFs")
+
+
+def normalized_member_sk(member_sk):
+    # MEMBER_SK as text, the same whether it was parsed as integers, as floats (e.g. in a
+    # column with missing values, 123 -> 123.0) or read as strings; missing values are ""
+    text = member_sk.astype("string").str.strip()
+    return text.str.replace(r"^(-?\d+)\.0*$", r"\1", regex=True).fillna("")
+
+
+def member_partitions(member_sk, n_partitions):
+    # Hash of the normalized MEMBER_SK, so the same member lands in the same bucket in every input
+    hashes = pd.util.hash_pandas_object(normalized_member_sk(member_sk), index=False).to_numpy()
+    return (hashes % n_partitions).astype(int)
+
+
+def _partition_dir(partition_root, partition):
+    return os.path.join(partition_root, f"part-{partition:05d}")
+
+
+def _has_member_sk(path):
+    if not path.endswith(".csv"):
+        return False
+    try:
+        return "MEMBER_SK" in pd.read_csv(path, nrows=0).columns
+    except (ValueError, UnicodeDecodeError, pd.errors.ParserError):
+        return False
+
+
+def _link(source, destination):
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    try:
+        os.symlink(os.path.abspath(source), destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def partition_file(path, relative_path, partition_root, n_partitions, chunksize=10 ** 6):
+    # Append every chunk's rows to the bucket files of their members, with a header
+    # in every bucket file, even when no member of the input falls into the bucket
+    if not _has_member_sk(path):
+        for partition in range(n_partitions):
+            _link(path, os.path.join(_partition_dir(partition_root, partition), relative_path))
+        return
+    header_written = set()
+    # MEMBER_SK is kept as text, so that its type is not inferred differently by chunk
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype={"MEMBER_SK": str}):
+        partitions = member_partitions(chunk["MEMBER_SK"], n_partitions)
+        for partition, rows in chunk.groupby(partitions, sort=False):
+            bucket_path = os.path.join(_partition_dir(partition_root, partition), relative_path)
+            if partition not in header_written:
+                os.makedirs(os.path.dirname(bucket_path), exist_ok=True)
+            rows.to_csv(bucket_path, mode="a" if partition in header_written else "w",
+                        header=partition not in header_written, index=False)
+            header_written.add(partition)
+    columns = pd.read_csv(path, nrows=0)
+    for partition in set(range(n_partitions)) - header_written:
+        bucket_path = os.path.join(_partition_dir(partition_root, partition), relative_path)
+        os.makedirs(os.path.dirname(bucket_path), exist_ok=True)
+        columns.to_csv(bucket_path, index=False)
+
+
+def partition_inputs(client_data_path, during_analysis_data_path, raw_RFs_path, partition_root,
+                     n_partitions, chunksize=10 ** 6):
+    if os.path.exists(partition_root) and os.listdir(partition_root):
+        raise ValueError(f"BASEHEALTH: the partition directory {partition_root} is not empty")
+    for root_name, input_root in zip(PARTITION_ROOTS, (client_data_path, during_analysis_data_path, raw_RFs_path)):
+        if os.path.isfile(input_root):
+            input_files = [(input_root, os.path.basename(input_root))]
+        else:
+            input_files = [(path, os.path.relpath(path, input_root))
+                           for path in glob(os.path.join(input_root, "**", "*"), recursive=True)
+                           if os.path.isfile(path)]
+        for path, relative_path in input_files:
+            partition_file(path, os.path.join(root_name, relative_path), partition_root, n_partitions,
+                           chunksize=chunksize)
+
+
+def _aggregate_partition(partition_path, prediction_year, raw_RFs_name, output_path, include_RAF=True,
+                         **aggregation_kwargs):
+    # Aggregate one bucket in memory and write its rows of data_to_model
+    # (imported here: main_aggregate_data writes through aggregation_output, which uses member_partitions)
+    from main_aggregate_data import AggregateAllDataInit
+    client_data_path, during_analysis_data_path, raw_RFs_root = \
+        [os.path.join(partition_path, root_name) for root_name in PARTITION_ROOTS]
+    aggregation = AggregateAllDataInit(prediction_year,
+                                       client_data_path=client_data_path,
+                                       during_analysis_data_path=during_analysis_data_path,
+                                       raw_RFs_path=os.path.join(raw_RFs_root, raw_RFs_name),
+                                       **aggregation_kwargs)
+    aggregation.run(include_RAF=include_RAF)
+    aggregation.data_to_model.to_csv(output_path, index=False)
+    return aggregation
+
+
+def aggregate_partition(partition_path, prediction_year, raw_RFs_name, output_path, include_RAF=True,
+                        **aggregation_kwargs):
+    _aggregate_partition(partition_path, prediction_year, raw_RFs_name, output_path, include_RAF=include_RAF,
+                         **aggregation_kwargs)
+    return output_path
+
+
+def _aggregate_partition_stages(partition_path, prediction_year, raw_RFs_name, output_path, include_RAF=True,
+                                **aggregation_kwargs):
+    # aggregate_partition in a worker process, returning the stage metrics recorded there
+    aggregation = _aggregate_partition(partition_path, prediction_year, raw_RFs_name, output_path,
+                                       include_RAF=include_RAF, **aggregation_kwargs)
+    return output_path, aggregation.metrics.stages
+
+
+def aggregate_partitioned(prediction_year, client_data_path, during_analysis_data_path, raw_RFs_path,
+                          partition_root, output_dir, n_partitions=16, workers=1, include_RAF=True,
+                          chunksize=10 ** 6, **aggregation_kwargs):
+    # Partition the inputs, then aggregate the buckets one at a time (or in up to
+    # `workers` processes), each into output_dir/part-NNNNN.csv. With workers, a
+    # `metrics` keyword is not sent to the processes: every bucket records its own
+    # stages, which are added to `metrics` with the bucket's number. Profiling is
+    # only supported with workers=1, as a profiler cannot be sent to another process.
+    metrics = aggregation_kwargs.pop("metrics", None) if workers > 1 else None
+    if metrics is not None and (metrics.profiler is not None or metrics.profiler_hook is not None):
+        raise ValueError("BASEHEALTH: profiling the partitioned aggregation is only supported with workers=1")
+    partition_inputs(client_data_path, during_analysis_data_path, raw_RFs_path, partition_root,
+                     n_partitions, chunksize=chunksize)
+    os.makedirs(output_dir, exist_ok=True)
+    partition_args = [(_partition_dir(partition_root, partition), prediction_year, os.path.basename(raw_RFs_path),
+                       os.path.join(output_dir, f"part-{partition:05d}.csv"))
+                      for partition in range(n_partitions)]
+    if workers == 1:
+        return [aggregate_partition(*args, include_RAF=include_RAF, **aggregation_kwargs)
+                for args in partition_args]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_aggregate_partition_stages, *args, include_RAF=include_RAF, **aggregation_kwargs)
+                   for args in partition_args]
+        output_paths = []
+        for partition, future in enumerate(futures):
+            output_path, stages = future.result()
+            output_paths.append(output_path)
+            if metrics is not None:
+                metrics.stages += [dict(stage, partition=partition) for stage in stages]
+        return output_paths
+
+
+def read_partitioned_output(output_dir, compact_dtypes=False):
+    # Concatenation of the buckets' data_to_model, sorted by MEMBER_SK since the buckets
+    # do not keep the members' order: compare it with the in-memory data_to_model sorted
+    # the same way. Columns missing from a bucket (e.g. a month without eligibility
+    # records among its members) are NA. Dtypes are inferred from the CSV parts, as when
+    # reading aggregatedData.csv; compact_dtypes applies the aggregation schema instead.
+    data = pd.concat([pd.read_csv(path) for path in sorted(glob(os.path.join(output_dir, "part-*.csv")))],
+                     ignore_index=True)
+    data = data.sort_values("MEMBER_SK", kind="mergesort", ignore_index=True)
+    return compact_frame(data) if compact_dtypes else data
@@ -0,0 +1,82 @@
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Columns matching `pattern` belong to `group` and are stored as `kind`:
+# "category" for repeated strings, "flag" for 0/1 values (int8, float32 when missing),
+# "sparse" for mostly zero counts, "float32" for measurements and "keep" to leave as is.
+# The first matching rule applies; the raw risk factor names are matched as well as
+# the names they are renamed to.
+ColumnRule = namedtuple("ColumnRule", ["group", "pattern", "kind"])
+
+AGGREGATION_SCHEMA = [
+    ColumnRule("id", r"^MEMBER_SK$", "keep"),
+    ColumnRule("demographics", r"^(Gender|Ethnicity|Smok(ing|er)[ _](Status|Freq)|Alcohol[ _](Status|Freq))$",
+               "category"),
+    ColumnRule("demographics", r"^(Age|Patient_Age|DOD|MEM_DOD)$", "float32"),
+    ColumnRule("provider", r"^(POVIDER_NAME|PROVIDER_NAME|PROVIDER_OFFICE_NAME|PROVIDER_NETWORK)$", "category"),
+    ColumnRule("flags", r"( Flag|Chol Drug|BP Drug|^DOD[ _]IND)$", "flag"),
+    ColumnRule("flags", r"^(Diabetes|Coronary_artery_disease|CANCER_COLORECTAL|CANCER_BREAST|Dementia|"
+                        r"CHOLESTEROL_DRUG|BP_DRUG|Hyperlipidemia|Hypertension)$", "flag"),
+    ColumnRule("statuses", r"^Status", "flag"),
+    ColumnRule("claims", r"^(Claims|Category|Term)", "sparse"),
+    ColumnRule("eligibility", r"^Eligibility", "float32"),
+    ColumnRule("RAF", r"^RAF", "float32"),
+    ColumnRule("adjusted_ORs", r"^BH-", "float32"),
+    # Everything else numeric is a lab value
+    ColumnRule("labs", r"", "float32"),
+]
+
+# Share of zeros from which a claims column is stored sparse
+SPARSE_ZERO_FRACTION = 0.9
+
+
+def column_group(column, schema=AGGREGATION_SCHEMA):
+    for rule in schema:
+        if re.search(rule.pattern, str(column)):
+            return rule.group, rule.kind
+    return "other", "keep"
+
+
+def _compact_column(values, kind):
+    if kind == "keep" or isinstance(values.dtype, (pd.CategoricalDtype, pd.SparseDtype)):
+        return values
+    if kind == "category":
+        return values.astype("category")
+    if not pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+        return values
+    if kind == "flag":
+        if values.isin([0, 1]).all():
+            return values.astype(np.int8)
+        return values.astype(np.float32)
+    if kind == "sparse":
+        if len(values) and (values == 0).mean() >= SPARSE_ZERO_FRACTION:
+            dtype = np.float32 if values.isnull().any() or pd.api.types.is_float_dtype(values) \
+                else np.int32
+            return values.astype(pd.SparseDtype(dtype, 0))
+        if pd.api.types.is_integer_dtype(values):
+            return pd.to_numeric(values, downcast="integer")
+        return values.astype(np.float32)
+    return values.astype(np.float32)
+
+
+def compact_frame(data, schema=AGGREGATION_SCHEMA):
+    # Store every column with the dtype of its group in the schema; already compact
+    # columns are left alone, so this can be applied again after every step
+    compacted = {column: _compact_column(data[column], column_group(column, schema)[1])
+                 for column in data.columns}
+    return pd.DataFrame(compacted, index=data.index)
+
+
+def memory_report(data, schema=AGGREGATION_SCHEMA):
+    # Number of columns and bytes used by every column group, largest first
+    column_bytes = data.memory_usage(index=False, deep=True)
+    groups = [column_group(column, schema)[0] for column in data.columns]
+    report = pd.DataFrame({"group": groups, "bytes": column_bytes.values,
+                           "dtype": [str(i) for i in data.dtypes]})
+    report = report.groupby("group").agg(columns=("bytes", "size"), bytes=("bytes", "sum"),
+                                         dtypes=("dtype", lambda x: ", ".join(sorted(set(x)))))
+    report["MB"] = report["bytes"] / 2 ** 20
+    return report.sort_values("bytes", ascending=False)
@@ -0,0 +1,89 @@
+import os
+import json
+import pickle
+import hashlib
+from collections import namedtuple
+
+# A stage computes its output from the outputs of the stages it depends on and from
+# its input files. Its fingerprint covers the content of the input files, the outputs
+# of its dependencies and its parameters, so a stage is only recomputed when one of
+# those changed, and a recomputed stage whose output did not change does not
+# invalidate the stages after it.
+Stage = namedtuple("Stage", ["name", "run", "input_files", "depends_on", "params"])
+
+
+def files_fingerprint(paths):
+    fingerprint = hashlib.sha1()
+    for path in sorted(paths):
+        files = [path] if not os.path.isdir(path) else \
+            sorted(os.path.join(path, i) for i in os.listdir(path) if os.path.isfile(os.path.join(path, i)))
+        for file_path in files:
+            fingerprint.update(file_path.encode("utf-8"))
+            if not os.path.exists(file_path):
+                fingerprint.update(b"missing")
+                continue
+            with open(file_path, "rb") as f:
+                for block in iter(lambda: f.read(2 ** 20), b""):
+                    fingerprint.update(block)
+    return fingerprint.hexdigest()
+
+
+class StageGraph():
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.stages = {}
+        self.index_path = os.path.join(cache_dir, "stages.json")
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def add(self, name, run, input_files=(), depends_on=(), params=None):
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"BASEHEALTH: stage {name} depends on the unknown stage {dependency}")
+        self.stages[name] = Stage(name, run, list(input_files), list(depends_on), params)
+        return self
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _save_index(self, index):
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(temporary_path, self.index_path)
+
+    def execute(self):
+        # Stages are added after their dependencies, so they run in insertion order.
+        # Returns the outputs of all stages and whether each was reused or recomputed.
+        index = self._load_index()
+        outputs, output_fingerprints, statuses = {}, {}, {}
+        for stage in self.stages.values():
+            fingerprint = hashlib.sha1(json.dumps(
+                [stage.name, repr(stage.params), files_fingerprint(stage.input_files),
+                 [output_fingerprints[i] for i in stage.depends_on]]).encode("utf-8")).hexdigest()
+            entry = index.get(stage.name)
+            if entry is not None and entry["fingerprint"] == fingerprint and \
+                    os.path.exists(os.path.join(self.cache_dir, entry["file"])):
+                with open(os.path.join(self.cache_dir, entry["file"]), "rb") as f:
+                    outputs[stage.name] = pickle.load(f)
+                output_fingerprints[stage.name] = entry["output_fingerprint"]
+                statuses[stage.name] = "reused"
+            else:
+                outputs[stage.name] = stage.run(*[outputs[i] for i in stage.depends_on])
+                output = pickle.dumps(outputs[stage.name], protocol=pickle.HIGHEST_PROTOCOL)
+                output_fingerprints[stage.name] = hashlib.sha1(output).hexdigest()
+                output_file = f"{stage.name}-{fingerprint[:16]}.pkl"
+                with open(os.path.join(self.cache_dir, output_file + ".tmp"), "wb") as f:
+                    f.write(output)
+                os.replace(os.path.join(self.cache_dir, output_file + ".tmp"), os.path.join(self.cache_dir, output_file))
+                if entry is not None and entry["file"] != output_file and \
+                        os.path.exists(os.path.join(self.cache_dir, entry["file"])):
+                    os.remove(os.path.join(self.cache_dir, entry["file"]))
+                index[stage.name] = {"fingerprint": fingerprint, "file": output_file,
+                                     "output_fingerprint": output_fingerprints[stage.name]}
+                self._save_index(index)
+                statuses[stage.name] = "recomputed"
+            print(f"Stage {stage.name}: {statuses[stage.name]}")
+        return outputs, statuses
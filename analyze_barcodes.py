@@ -1,13 +1,29 @@
 import os
 import sys
-import time
+import gzip
+import json
 import argparse
 import numpy as np
 import pandas as pd
 import pyfastx
 import operator
-from collections import defaultdict
-from matplotlib import pyplot as plt
+import pickle
+import itertools
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from numpy.lib.stride_tricks import sliding_window_view
+from barcode_locations import BarcodeLocations, BarcodeGridIndex
+from pipeline_metrics import PipelineMetrics
+from barcode_count_files import write_count_file
+from barcode_statistics import BarcodeCountStatistics, plot_count_statistics
+from barcode_sketches import ApproximateBarcodeCounter
+from barcode_encoding import code_dtype, pack_bases, decode_barcodes, reverse_complement_codes
+from barcode_packed_counts import PackedBarcodeCounts
+
+
+# Translation table used to complement many barcodes at once
+BASE_COMPLEMENT_TABLE = str.maketrans('ATGCN', 'TACGN')
 
 
 def reverse_complement(s):
@@ -73,19 +89,101 @@ def iterate_over_dict(barcode_dict):
     return final_barcodes_with_mismatch
 
 
-def create_barcode_frequency_dict(fastq, forward_tag='CAT', reverse_tag='GTA'):
+def build_mismatch_index(barcodes):
     """
-    Create a dictionary with unique barcodes as keys,
-    :param fastq:
-    :param forward_tag:
-    :param reverse_tag:
-    :return:
+    Index barcodes by every single-position masked version of themselves.
+    Two distinct barcodes of equal length share a masked key if and only if
+    they differ at exactly that one position, i.e. their hamming distance is 1.
+    :param barcodes: iterable of barcode strings
+    :return: dictionary of (position, masked barcode) keys and lists of barcodes
+    """
+    # Time complexity O(n * L) for n barcodes of length L
+    mismatch_index = defaultdict(list)
+    for _barcode in barcodes:
+        for i in range(len(_barcode)):
+            mismatch_index[(i, _barcode[:i] + _barcode[i + 1:])].append(_barcode)
+    return mismatch_index
+
+
+def iterate_over_dict_indexed(barcode_dict):
+    """
+    Same result as `iterate_over_dict`, but look up barcodes with one mismatch
+    in a masked-key index instead of comparing every pair of barcodes.
+    :param barcode_dict: original barcodes dictionary
+    containing counts and X/Y positions
+    :return: final reduced barcodes dictionary
+    """
+    # sort in descending order of value to start with most frequent barcode
+    sorted_barcode_dict = dict(sorted(barcode_dict.items(), key=operator.itemgetter(1), reverse=True))
+    mismatch_index = build_mismatch_index(sorted_barcode_dict.keys())
+    processed_barcodes = set()
+    final_barcodes_with_mismatch = defaultdict(int)
+    # Complexity O(n * L) instead of O(n^2 * L)
+    for _barcode, _count in sorted_barcode_dict.items():
+        # Skip if barcode already seen before
+        if _barcode in processed_barcodes:
+            continue
+        processed_barcodes.add(_barcode)
+        final_barcodes_with_mismatch[_barcode] = _count
+        # only barcodes sharing a masked key can be one mismatch away
+        for i in range(len(_barcode)):
+            for _to_be_checked_barcode in mismatch_index[(i, _barcode[:i] + _barcode[i + 1:])]:
+                # skip if already counted towards higher freq barcode
+                if _to_be_checked_barcode in processed_barcodes:
+                    continue
+                final_barcodes_with_mismatch[_barcode] += barcode_dict[_to_be_checked_barcode]
+                processed_barcodes.add(_to_be_checked_barcode)
+    return final_barcodes_with_mismatch
+
+
+# Mismatch collapsing engines selectable from the command line
+COLLAPSE_METHODS = {
+    'index': iterate_over_dict_indexed,
+    'pairwise': iterate_over_dict
+}
+
+
+def collapse_barcode_counts(barcode_counts, collapse_method='index'):
+    """
+    Merge barcodes with one mismatch
+    :param barcode_counts: dictionary of barcode counts, or PackedBarcodeCounts,
+        which are merged on the packed barcodes (same result as every method)
+    :param collapse_method: key of COLLAPSE_METHODS used for dictionaries
+    :return: final reduced barcodes dictionary
+    """
+    if isinstance(barcode_counts, PackedBarcodeCounts):
+        return barcode_counts.collapse()
+    return COLLAPSE_METHODS[collapse_method](barcode_counts)
+
+
+class _ReadCounter(object):
+    """Iterate over reads, counting how many were read"""
+
+    def __init__(self, fastq):
+        self.fastq = fastq
+        self.n_reads = 0
+
+    def __iter__(self):
+        for read in self.fastq:
+            self.n_reads += 1
+            yield read
+
+
+def count_barcode_reads(fastq, forward_tag='CAT', reverse_tag='GTA', skip_undetermined=False):
+    """
+    Count the barcodes of the reads, before merging barcodes with one mismatch
+    :param fastq: iterable of (name, seq, quality, comment) reads
+    :param forward_tag: forward strand identifier
+    :param reverse_tag: reverse strand identifier
+    :param skip_undetermined: skip reads starting with neither tag instead of raising an error
+    :return: 2 dictionaries of barcode frequencies from forward and reverse strands
+        and 2 BarcodeLocations stores of their x and y positions
     """
     # Initialize forward and reverse strand dictionaries
     barcode_counts_forward = defaultdict(int)
-    barcode_loc_forward = defaultdict(list)
+    barcode_loc_forward = BarcodeLocations()
     barcode_counts_reverse = defaultdict(int)
-    barcode_loc_reverse = defaultdict(list)
+    barcode_loc_reverse = BarcodeLocations()
     for name, seq, quality, comment in fastq:
         # Get X and Y location for each read
         x_location, y_location = float(name.split(':')[2]), float(name.split(':')[3].split('#')[0])
@@ -95,41 +193,700 @@ def create_barcode_frequency_dict(fastq, forward_tag='CAT', reverse_tag='GTA'):
             _barcode = seq[3:11]
             # Add the counts and X and Y positions to the dictionary
             barcode_counts_forward[_barcode] += 1
-            barcode_loc_forward[_barcode].append([x_location, y_location])
+            barcode_loc_forward.append(_barcode, x_location, y_location)
         elif seq.startswith(reverse_tag):
             _barcode = seq[3:11]
             # Get reverse complement of reverse strand (in order to simplify search and comparisons)
             _rev_complement_barcode = reverse_complement(_barcode)
             barcode_counts_reverse[_rev_complement_barcode] += 1
-            barcode_loc_reverse[_barcode].append([x_location, y_location])
-        else:
+            # Key the locations the same way as the counts
+            barcode_loc_reverse.append(_rev_complement_barcode, x_location, y_location)
+        elif not skip_undetermined:
             raise Exception("Cannot determine the orientation of read.")
-    barcode_counts_forward = iterate_over_dict(barcode_counts_forward)
-    barcode_counts_reverse = iterate_over_dict(barcode_counts_reverse)
     return barcode_counts_forward, barcode_counts_reverse, barcode_loc_forward, barcode_loc_reverse
 
 
-def barcodes_dict_from_fastq(fq_file, tags):
+def create_barcode_frequency_dict(fastq, forward_tag='CAT', reverse_tag='GTA', collapse_method='index'):
+    """
+    Create a dictionary with unique barcodes as keys,
+    :param fastq:
+    :param forward_tag:
+    :param reverse_tag:
+    :param collapse_method: key of COLLAPSE_METHODS used to merge barcodes with one mismatch
+    :return:
+    """
+    barcode_counts_forward, barcode_counts_reverse, barcode_loc_forward, barcode_loc_reverse = \
+        count_barcode_reads(fastq, forward_tag=forward_tag, reverse_tag=reverse_tag)
+    collapse_barcodes = COLLAPSE_METHODS[collapse_method]
+    barcode_counts_forward = collapse_barcodes(barcode_counts_forward)
+    barcode_counts_reverse = collapse_barcodes(barcode_counts_reverse)
+    return barcode_counts_forward, barcode_counts_reverse, barcode_loc_forward, barcode_loc_reverse
+
+
+def _read_location(name):
+    # X and Y location of a read from its name, as in `count_barcode_reads`
+    return float(name.split(':')[2]), float(name.split(':')[3].split('#')[0])
+
+
+def _parse_decimals(rows, starts, ends, max_digits=15):
+    """
+    Parse the numbers rows[i, starts[i]:ends[i]] of a matrix of bytes, vectorized
+    for plain integers and with `float` for the rest (e.g. 12.5 or 1e3)
+    :param rows: (n, width) uint8 array
+    :param starts: int64 array of the first column of each number
+    :param ends: int64 array of the column after each number
+    :param max_digits: longest integer parsed vectorized
+    :return: float64 array of numbers
+    """
+    numbers = np.zeros(len(rows), dtype=np.int64)
+    plain = (ends > starts) & (ends - starts <= max_digits)
+    for column in range(int(starts.min(initial=rows.shape[1])), int(ends.max(initial=0))):
+        inside = (starts <= column) & (column < ends)
+        digits = rows[:, column].astype(np.int64) - ord('0')
+        plain &= ~inside | ((digits >= 0) & (digits <= 9))
+        numbers = np.where(inside, numbers * 10 + digits, numbers)
+    numbers = numbers.astype(np.float64)
+    for i in np.flatnonzero(~plain):
+        numbers[i] = float(rows[i, starts[i]:ends[i]].tobytes().decode('latin-1'))
+    return numbers
+
+
+def _parse_locations(names):
+    """
+    X and Y locations of the reads from the `:` separated fields 2 and 3 of their
+    names (up to `#` for Y), as in `count_barcode_reads`, parsed for a block of reads at once
+    :param names: (reads, width) uint8 array of the name lines (after the `@`), each
+        row holding at least the newline ending the line
+    :return: float64 arrays of the X and Y locations
+    """
+    columns = np.arange(names.shape[1])
+    # The name ends at the first whitespace, like the names read by pyfastx
+    name_ends = np.argmax(names <= ord(' '), axis=1)
+    # Colons and `#` of the names, sorted by read
+    rows, found_columns = np.nonzero(((names == ord(':')) | (names == ord('#'))) & (columns < name_ends[:, None]))
+    is_colon = names[rows, found_columns] == ord(':')
+    hash_rows, hash_columns = rows[~is_colon], found_columns[~is_colon]
+    rows, colon_columns = rows[is_colon], found_columns[is_colon]
+    # Index of every colon among the colons of its name
+    first_colons = np.flatnonzero(np.diff(rows, prepend=-1))
+    colon_ranks = np.arange(len(rows)) - np.repeat(first_colons, np.diff(first_colons, append=len(rows)))
+
+    def colon(k):
+        # Column of the k-th colon of every name, the name end if missing
+        found = colon_ranks == k - 1
+        positions = name_ends.copy()
+        positions[rows[found]] = colon_columns[found]
+        return positions
+
+    second, third, fourth = colon(2), colon(3), colon(4)
+    # Y ends at the first `#` between the 3rd and 4th colon
+    in_field = (hash_columns > third[hash_rows]) & (hash_columns < fourth[hash_rows])
+    hash_rows, hash_columns = hash_rows[in_field], hash_columns[in_field]
+    first_hashes = np.diff(hash_rows, prepend=-1) != 0
+    y_ends = fourth.copy()
+    y_ends[hash_rows[first_hashes]] = hash_columns[first_hashes]
+    has_fields = third < name_ends
+    x_locations = np.empty(len(names), dtype=np.float64)
+    y_locations = np.empty(len(names), dtype=np.float64)
+    x_locations[has_fields] = _parse_decimals(names[has_fields], second[has_fields] + 1, third[has_fields])
+    y_locations[has_fields] = _parse_decimals(names[has_fields], third[has_fields] + 1, y_ends[has_fields])
+    for i in np.flatnonzero(~has_fields):
+        # Raises the same error as `count_barcode_reads` for names without locations
+        x_locations[i], y_locations[i] = _read_location(names[i, :name_ends[i]].tobytes().decode('latin-1'))
+    return x_locations, y_locations
+
+
+def _parse_fastq_block(buf, line_ends, prefix_length):
+    """
+    Parse a block of complete FastQ records (4 lines per read) from a byte buffer
+    :param buf: uint8 array of the records
+    :param line_ends: int64 array of the positions of the newlines of the block
+    :param prefix_length: number of bases kept from the start of every sequence
+    :return: (reads, prefix_length) uint8 array of the first bases of the sequences
+        (undefined after their end), array of the sequence lengths, and arrays of the X and Y locations
+    """
+    if len(line_ends) % 4:
+        raise ValueError("FastQ records must have 4 lines (unwrapped sequence and quality).")
+    line_starts = np.concatenate([[0], line_ends[:-1] + 1])
+    if not ((buf[line_starts[0::4]] == ord('@')).all() and (buf[line_starts[2::4]] == ord('+')).all()):
+        raise ValueError("FastQ records must have 4 lines (unwrapped sequence and quality).")
+    seq_starts, seq_ends = line_starts[1::4], line_ends[1::4]
+    # Windows line endings
+    seq_ends = seq_ends - (buf[seq_ends - 1] == ord('\r'))
+    lengths = np.maximum(seq_ends - seq_starts, 0)
+    # Fixed width rows of bytes starting at the names and sequences, copied row by row
+    name_width = int((line_ends[0::4] - line_starts[0::4]).max(initial=0))
+    padded = np.concatenate([buf, np.full(max(name_width, prefix_length), ord('\n'), dtype=np.uint8)])
+    prefixes = sliding_window_view(padded, prefix_length)[seq_starts]
+    x_locations, y_locations = _parse_locations(sliding_window_view(padded, name_width)[line_starts[0::4] + 1])
+    return prefixes, lengths, x_locations, y_locations
+
+
+def _starts_with(prefixes, lengths, tag):
+    # Reads whose sequence starts with the tag
+    tag = np.frombuffer(tag.encode('ascii'), dtype=np.uint8)
+    return (lengths >= len(tag)) & (prefixes[:, :len(tag)] == tag).all(axis=1)
+
+
+def _count_strand(prefixes, lengths, x_locations, y_locations, read_indices, counts, locations, reverse):
+    """
+    Count the barcodes of the reads of one strand from a block
+    :param prefixes: first bases of the sequences of the reads
+    :param lengths: sequence lengths of the reads
+    :param x_locations: X locations of the reads
+    :param y_locations: Y locations of the reads
+    :param read_indices: int64 array of the indices of the reads
+    :param counts: PackedBarcodeCounts of the strand
+    :param locations: BarcodeLocations of the strand, keyed by packed barcode or unpackable barcode string
+    :param reverse: count the reverse complements of the barcodes
+    """
+    barcode_length = counts.barcode_length
+    packed, valid = pack_bases(prefixes[:, 3:3 + barcode_length], barcode_length)
+    valid &= lengths >= 3 + barcode_length
+    packed = packed[valid]
+    if reverse:
+        packed = reverse_complement_codes(packed, barcode_length)
+    codes, first, inverse = np.unique(packed, return_index=True, return_inverse=True)
+    valid_rows, side_rows = np.flatnonzero(valid), np.flatnonzero(~valid)
+    counts.add(codes, np.bincount(inverse, minlength=len(codes)), read_indices[valid_rows[first]])
+    # Barcodes that cannot be packed, cut short by the end of the read
+    side_barcodes = [prefixes[row, 3:3 + barcode_length][:max(int(lengths[row]) - 3, 0)].tobytes().decode('latin-1')
+                     for row in side_rows.tolist()]
+    if reverse:
+        side_barcodes = [reverse_complement(_barcode) for _barcode in side_barcodes]
+    counts.add_side(side_barcodes, read_indices[side_rows].tolist())
+    side_ids, side_first, side_inverse = {}, [], []
+    for row, _barcode in zip(side_rows.tolist(), side_barcodes):
+        if _barcode not in side_ids:
+            side_ids[_barcode] = len(side_ids)
+            side_first.append(row)
+        side_inverse.append(side_ids[_barcode])
+    # Keys of the locations, in the order of their first read in the block
+    keys = codes.tolist() + list(side_ids)
+    order = np.argsort(np.concatenate([valid_rows[first], side_first]), kind='stable')
+    rank = np.empty(len(keys), dtype=np.int64)
+    rank[order] = np.arange(len(keys))
+    key_indices = np.empty(len(prefixes), dtype=np.int64)
+    key_indices[valid_rows] = rank[inverse.reshape(-1)]
+    key_indices[side_rows] = rank[len(codes) + np.array(side_inverse, dtype=np.int64)]
+    locations.extend_batch([keys[i] for i in order.tolist()], key_indices, x_locations, y_locations)
+
+
+def _count_encoded_block(buf, line_ends, read_offset, forward_tag, reverse_tag, counts_forward, counts_reverse,
+                         barcode_loc_forward, barcode_loc_reverse, skip_undetermined):
+    """
+    Count the barcodes of a block of FastQ records
+    :param buf: uint8 array of complete FastQ records
+    :param line_ends: int64 array of the positions of the newlines of the block
+    :param read_offset: index of the first read of the block
+    :param forward_tag: forward strand identifier
+    :param reverse_tag: reverse strand identifier
+    :param counts_forward: PackedBarcodeCounts of the forward strand
+    :param counts_reverse: PackedBarcodeCounts of the reverse strand
+    :param barcode_loc_forward: BarcodeLocations of the forward strand
+    :param barcode_loc_reverse: BarcodeLocations of the reverse strand
+    :param skip_undetermined: skip reads starting with neither tag instead of raising an error
+    :return: number of reads in the block
+    """
+    prefix_length = max(len(forward_tag), len(reverse_tag), 3 + counts_forward.barcode_length)
+    prefixes, lengths, x_locations, y_locations = _parse_fastq_block(buf, line_ends, prefix_length)
+    forward = _starts_with(prefixes, lengths, forward_tag)
+    reverse = ~forward & _starts_with(prefixes, lengths, reverse_tag)
+    if not skip_undetermined and not (forward | reverse).all():
+        raise Exception("Cannot determine the orientation of read.")
+    read_indices = read_offset + np.arange(len(prefixes), dtype=np.int64)
+    for strand, counts, locations, is_reverse in ((forward, counts_forward, barcode_loc_forward, False),
+                                                  (reverse, counts_reverse, barcode_loc_reverse, True)):
+        _count_strand(prefixes[strand], lengths[strand], x_locations[strand], y_locations[strand],
+                      read_indices[strand], counts, locations, is_reverse)
+    return len(prefixes)
+
+
+def _finish_encoded_counts(n_reads, counts_forward, counts_reverse, barcode_loc_forward, barcode_loc_reverse):
+    # Key the locations on the barcode strings of the counts, decoding each packed barcode once
+    counts_forward.n_reads = counts_reverse.n_reads = n_reads
+    for counts, locations in ((counts_forward, barcode_loc_forward), (counts_reverse, barcode_loc_reverse)):
+        packed = np.array([key for key in locations.keys() if not isinstance(key, str)],
+                          dtype=code_dtype(counts.barcode_length))
+        names = dict(zip(packed.tolist(), decode_barcodes(packed, counts.barcode_length) if len(packed) else []))
+        locations.rename_barcodes(lambda key: names.get(key, key))
+    return counts_forward, counts_reverse, barcode_loc_forward, barcode_loc_reverse
+
+
+def _fastq_blocks(fq_file, block_size):
+    """
+    Read a FastQ file in blocks of complete records
+    :param fq_file: input FastQ file, gzipped if it ends with `.gz`
+    :param block_size: number of bytes read at once
+    :return: generator of uint8 arrays of records and arrays of the positions of their newlines
+    """
+    if not (fq_file.endswith('.fq') or fq_file.endswith('.gz')):
+        raise NotImplementedError("File format not supported")
+    remainder = b''
+    with (gzip.open if fq_file.endswith('.gz') else open)(fq_file, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            data = remainder + data
+            buf = np.frombuffer(data, dtype=np.uint8)
+            line_ends = np.flatnonzero(buf == ord('\n'))
+            # Records continuing in the next block are carried over
+            complete = len(line_ends) - len(line_ends) % 4
+            if complete:
+                end = int(line_ends[complete - 1]) + 1
+                yield buf[:end], line_ends[:complete]
+                remainder = data[end:]
+            else:
+                remainder = data
+    if remainder.strip():
+        buf = np.frombuffer(remainder if remainder.endswith(b'\n') else remainder + b'\n', dtype=np.uint8)
+        yield buf, np.flatnonzero(buf == ord('\n'))
+
+
+def count_barcode_file_encoded(fq_file, forward_tag='CAT', reverse_tag='GTA', barcode_length=8, block_size=2 ** 24,
+                               skip_undetermined=False):
+    """
+    Same output as `count_barcode_reads_encoded`, reading the FastQ file in blocks of
+    bytes and extracting the tags, barcodes and locations of each block at once
+    :param fq_file: input FastQ file (4 lines per read), gzipped if it ends with `.gz`
+    :param forward_tag: forward strand identifier
+    :param reverse_tag: reverse strand identifier
+    :param barcode_length: number of bases after the tag used as barcode
+    :param block_size: number of bytes read at once
+    :param skip_undetermined: skip reads starting with neither tag instead of raising an error
+    :return: 2 PackedBarcodeCounts of barcode frequencies from forward and reverse strands
+        and 2 BarcodeLocations stores of their x and y positions
+    """
+    counts_forward, counts_reverse = PackedBarcodeCounts(barcode_length), PackedBarcodeCounts(barcode_length)
+    barcode_loc_forward, barcode_loc_reverse = BarcodeLocations(), BarcodeLocations()
+    n_reads = 0
+    for buf, line_ends in _fastq_blocks(fq_file, block_size):
+        n_reads += _count_encoded_block(buf, line_ends, n_reads, forward_tag, reverse_tag, counts_forward,
+                                        counts_reverse, barcode_loc_forward, barcode_loc_reverse, skip_undetermined)
+    return _finish_encoded_counts(n_reads, counts_forward, counts_reverse, barcode_loc_forward, barcode_loc_reverse)
+
+
+def count_barcode_reads_encoded(fastq, forward_tag='CAT', reverse_tag='GTA', barcode_length=8, batch_size=100000,
+                                skip_undetermined=False):
+    """
+    Same counts as `count_barcode_reads`, but barcodes are packed into integers
+    (2 bits per base) and counted in a dense 4^barcode_length array. The reads are
+    written back to a byte buffer in batches, parsed the same way as in
+    `count_barcode_file_encoded`.
+    :param fastq: iterable of (name, seq, quality, comment) reads
+    :param forward_tag: forward strand identifier
+    :param reverse_tag: reverse strand identifier
+    :param barcode_length: number of bases after the tag used as barcode
+    :param batch_size: number of reads parsed at once
+    :param skip_undetermined: skip reads starting with neither tag instead of raising an error
+    :return: 2 PackedBarcodeCounts of barcode frequencies from forward and reverse strands
+        and 2 BarcodeLocations stores of their x and y positions
+    """
+    counts_forward, counts_reverse = PackedBarcodeCounts(barcode_length), PackedBarcodeCounts(barcode_length)
+    barcode_loc_forward, barcode_loc_reverse = BarcodeLocations(), BarcodeLocations()
+    n_reads = 0
+    for batch in _read_shards(fastq, batch_size):
+        buf = np.frombuffer(''.join(['@%s\n%s\n+\n\n' % read for read in batch]).encode('latin-1'), dtype=np.uint8)
+        n_reads += _count_encoded_block(buf, np.flatnonzero(buf == ord('\n')), n_reads, forward_tag, reverse_tag,
+                                        counts_forward, counts_reverse, barcode_loc_forward, barcode_loc_reverse,
+                                        skip_undetermined)
+    return _finish_encoded_counts(n_reads, counts_forward, counts_reverse, barcode_loc_forward, barcode_loc_reverse)
+
+
+def create_barcode_frequency_dict_encoded(fastq, forward_tag='CAT', reverse_tag='GTA', collapse_method='index',
+                                          barcode_length=8, batch_size=100000):
+    """
+    Same output as `create_barcode_frequency_dict`, counting the
+    barcodes with `count_barcode_reads_encoded`
+    :param fastq: iterable of (name, seq, quality, comment) reads
+    :param forward_tag: forward strand identifier
+    :param reverse_tag: reverse strand identifier
+    :param collapse_method: unused, barcodes are merged on the packed barcodes with the same result
+    :param barcode_length: number of bases after the tag used as barcode
+    :param batch_size: number of reads parsed at once
+    :return: 2 dictionaries of barcode frequencies from forward and reverse strands
+        and 2 BarcodeLocations stores of their x and y positions
+    """
+    barcode_counts_forward, barcode_counts_reverse, barcode_loc_forward, barcode_loc_reverse = \
+        count_barcode_reads_encoded(fastq, forward_tag=forward_tag, reverse_tag=reverse_tag,
+                                    barcode_length=barcode_length, batch_size=batch_size)
+    barcode_counts_forward = collapse_barcode_counts(barcode_counts_forward)
+    barcode_counts_reverse = collapse_barcode_counts(barcode_counts_reverse)
+    return barcode_counts_forward, barcode_counts_reverse, barcode_loc_forward, barcode_loc_reverse
+
+
+def _count_shard(shard, forward_tag, reverse_tag, encoded, skip_undetermined=False):
+    """
+    Count the barcodes of one shard of reads in a worker process
+    :param shard: list of (name, seq) reads
+    :param forward_tag: forward strand identifier
+    :param reverse_tag: reverse strand identifier
+    :param encoded: count 2-bit packed barcodes instead of string keyed dictionaries
+    :param skip_undetermined: skip reads starting with neither tag instead of raising an error
+    :return: the counts and location stores of `count_barcode_reads` for the shard
+    """
+    count_reads = count_barcode_reads_encoded if encoded else count_barcode_reads
+    return count_reads(((name, seq, None, None) for name, seq in shard),
+                       forward_tag=forward_tag, reverse_tag=reverse_tag, skip_undetermined=skip_undetermined)
+
+
+def _empty_counts(encoded=False):
+    if encoded:
+        return PackedBarcodeCounts(), PackedBarcodeCounts(), BarcodeLocations(), BarcodeLocations()
+    return defaultdict(int), defaultdict(int), BarcodeLocations(), BarcodeLocations()
+
+
+def merge_barcode_counts(merged, shard_counts):
+    """
+    Merge the barcode counts and X/Y positions of a shard into the running result.
+    Shards have to be merged in the order of their reads, so that the merged
+    dictionaries have the same order and locations as a single-process run.
+    :param merged: forward/reverse count dictionaries (or PackedBarcodeCounts) and location stores merged so far
+    :param shard_counts: forward/reverse count dictionaries (or PackedBarcodeCounts) and location stores
+        of the next shard
+    :return: merged dictionaries
+    """
+    barcode_counts_forward, barcode_counts_reverse, barcode_loc_forward, barcode_loc_reverse = merged
+    shard_counts_forward, shard_counts_reverse, shard_loc_forward, shard_loc_reverse = shard_counts
+    for barcode_counts, shard_barcode_counts in ((barcode_counts_forward, shard_counts_forward),
+                                                 (barcode_counts_reverse, shard_counts_reverse)):
+        if isinstance(barcode_counts, PackedBarcodeCounts):
+            barcode_counts.merge(shard_barcode_counts)
+            continue
+        for _barcode, _count in shard_barcode_counts.items():
+            barcode_counts[_barcode] += _count
+    barcode_loc_forward.extend(shard_loc_forward)
+    barcode_loc_reverse.extend(shard_loc_reverse)
+    return merged
+
+
+def _read_shards(fastq, shard_size):
+    """
+    Split reads into consecutive shards of (name, seq) tuples
+    :param fastq: iterable of (name, seq, quality, comment) reads
+    :param shard_size: number of reads per shard
+    :return: generator of shards
+    """
+    shard = []
+    for name, seq, quality, comment in fastq:
+        shard.append((name, seq))
+        if len(shard) >= shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def _counted_shards(shards, count_shard, workers=1):
+    """
+    Count shards of reads, in a pool of worker processes if workers > 1
+    :param shards: iterable of shards of (name, seq) reads
+    :param count_shard: function counting one shard
+    :param workers: number of worker processes
+    :return: generator of (shard size, shard counts), in the order of the shards
+    """
+    if workers <= 1:
+        for shard in shards:
+            yield len(shard), count_shard(shard)
+        return
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Only keep a couple of shards per worker in flight to bound memory
+        for shard in shards:
+            pending.append((len(shard), executor.submit(count_shard, shard)))
+            if len(pending) >= 2 * workers:
+                shard_size, future = pending.popleft()
+                yield shard_size, future.result()
+        while pending:
+            shard_size, future = pending.popleft()
+            yield shard_size, future.result()
+
+
+def count_barcode_reads_parallel(fastq, forward_tag='CAT', reverse_tag='GTA', workers=2,
+                                 shard_size=200000, encoded=False, skip_undetermined=False):
+    """
+    Same output as `count_barcode_reads`, but the reads are split into
+    consecutive shards that are counted in a pool of worker processes,
+    and the shard counts are merged in read order.
+    :param fastq: iterable of (name, seq, quality, comment) reads
+    :param forward_tag: forward strand identifier
+    :param reverse_tag: reverse strand identifier
+    :param workers: number of worker processes
+    :param shard_size: number of reads per shard
+    :param encoded: count 2-bit packed barcodes instead of string keyed dictionaries
+    :param skip_undetermined: skip reads starting with neither tag instead of raising an error
+    :return: 2 dictionaries of barcode frequencies from forward and reverse strands
+        and 2 BarcodeLocations stores of their x and y positions
+    """
+    merged = _empty_counts(encoded)
+    count_shard = partial(_count_shard, forward_tag=forward_tag, reverse_tag=reverse_tag, encoded=encoded,
+                          skip_undetermined=skip_undetermined)
+    for _, shard_counts in _counted_shards(_read_shards(fastq, shard_size), count_shard, workers):
+        merge_barcode_counts(merged, shard_counts)
+    return merged
+
+
+def save_checkpoint(checkpoint_file, fingerprint, reads_processed, counts):
+    """
+    Append the barcode counts of the batches since the previous checkpoint to the
+    checkpoint file, so that each checkpoint only writes the new counts
+    :param checkpoint_file: path of the checkpoint file
+    :param fingerprint: description of the input and options the counts belong to
+    :param reads_processed: number of reads counted so far, including these counts
+    :param counts: forward/reverse count dictionaries and location stores since the previous checkpoint
+    """
+    new_file = not os.path.exists(checkpoint_file)
+    with open(checkpoint_file, 'ab') as f:
+        if new_file:
+            pickle.dump({'fingerprint': fingerprint}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # A record cut short by an interruption is dropped by load_checkpoint
+        pickle.dump({'reads_processed': reads_processed, 'counts': counts}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_checkpoint(checkpoint_file, fingerprint, encoded=False):
+    """
+    Read and merge the running barcode counts appended by `save_checkpoint`
+    :param checkpoint_file: path of the checkpoint file
+    :param fingerprint: description of the input and options of the current run
+    :param encoded: the counts are PackedBarcodeCounts
+    :return: number of reads already counted and the counts, or None if there is no checkpoint
+    """
+    if not os.path.exists(checkpoint_file):
+        return None
+    reads_processed, merged = 0, _empty_counts(encoded)
+    with open(checkpoint_file, 'r+b') as f:
+        header = pickle.load(f)
+        if header['fingerprint'] != fingerprint:
+            raise ValueError(f"Checkpoint {checkpoint_file} was written for a different input or options: "
+                             f"{header['fingerprint']}")
+        complete_size = f.tell()
+        while True:
+            try:
+                checkpoint = pickle.load(f)
+            except (EOFError, ValueError, pickle.UnpicklingError):
+                break
+            reads_processed = checkpoint['reads_processed']
+            merge_barcode_counts(merged, checkpoint['counts'])
+            complete_size = f.tell()
+        # Drop an incomplete last record, so the next checkpoints are appended after the complete ones
+        f.truncate(complete_size)
+    return reads_processed, merged
+
+
+def count_barcode_reads_streaming(fastq, checkpoint_file, fingerprint=None, forward_tag='CAT', reverse_tag='GTA',
+                                  batch_size=1000000, checkpoint_interval=10, encoded=False, workers=1,
+                                  skip_undetermined=False):
+    """
+    Same output as `count_barcode_reads`, but the reads are counted in fixed-size
+    batches and the counts of every few batches are appended to a checkpoint file.
+    If the checkpoint file already exists, counting resumes after the reads it covers;
+    the reads before are still parsed again to get there, but not counted.
+    :param fastq: iterable of (name, seq, quality, comment) reads
+    :param checkpoint_file: path of the checkpoint file
+    :param fingerprint: description of the input and options, checked when resuming
+    :param forward_tag: forward strand identifier
+    :param reverse_tag: reverse strand identifier
+    :param batch_size: number of reads per batch
+    :param checkpoint_interval: number of batches between checkpoints
+    :param encoded: count 2-bit packed barcodes instead of string keyed dictionaries
+    :param workers: number of worker processes counting the batches
+    :param skip_undetermined: skip reads starting with neither tag instead of raising an error
+    :return: 2 dictionaries of barcode frequencies from forward and reverse strands
+        and 2 BarcodeLocations stores of their x and y positions
+    """
+    checkpoint = load_checkpoint(checkpoint_file, fingerprint, encoded)
+    if checkpoint is None:
+        reads_processed = 0
+        merged = _empty_counts(encoded)
+    else:
+        reads_processed, merged = checkpoint
+        print(f"Resuming from checkpoint after {reads_processed} reads...\n\n")
+    count_shard = partial(_count_shard, forward_tag=forward_tag, reverse_tag=reverse_tag, encoded=encoded,
+                          skip_undetermined=skip_undetermined)
+    # Reads before the checkpoint are skipped, not counted again
+    batches = _read_shards(itertools.islice(fastq, reads_processed, None), batch_size)
+    # Counts of the batches since the last checkpoint, merged into the result once checkpointed
+    pending = _empty_counts(encoded)
+    for batch_number, (batch_size_read, batch_counts) in enumerate(_counted_shards(batches, count_shard, workers), 1):
+        merge_barcode_counts(pending, batch_counts)
+        reads_processed += batch_size_read
+        if batch_number % checkpoint_interval == 0:
+            save_checkpoint(checkpoint_file, fingerprint, reads_processed, pending)
+            merge_barcode_counts(merged, pending)
+            pending = _empty_counts(encoded)
+    save_checkpoint(checkpoint_file, fingerprint, reads_processed, pending)
+    merge_barcode_counts(merged, pending)
+    return merged
+
+
+def _open_fastq(fq_file):
+    """
+    :param fq_file: input FastQ file
+    :return: pyfastx iterator of (name, seq, quality, comment) reads
+    """
+    # Read fastq file
+    if fq_file.endswith('.fq') or fq_file.endswith('.gz'):
+        return pyfastx.Fastx(fq_file, comment=True)
+    # If file extension not `.fq` raise an error
+    raise NotImplementedError("File format not supported")
+
+
+def count_barcode_reads_approximate(fastq, forward_tag='CAT', reverse_tag='GTA', sketch_width=2 ** 20,
+                                    sketch_depth=4, hll_precision=14, top_k=10000, batch_size=100000,
+                                    skip_undetermined=False, barcode_length=8):
+    """
+    Count the barcodes of the reads in fixed memory: count-min sketch frequencies,
+    HyperLogLog distinct counts and only the top-K most frequent barcodes are kept.
+    X/Y locations are not kept in this mode.
+    :param fastq: iterable of (name, seq, quality, comment) reads
+    :param forward_tag: forward strand identifier
+    :param reverse_tag: reverse strand identifier
+    :param sketch_width: number of counters per row of the count-min sketch
+    :param sketch_depth: number of rows of the count-min sketch
+    :param hll_precision: number of index bits of the HyperLogLog (2^precision registers)
+    :param top_k: number of heavy hitter barcodes kept per strand
+    :param batch_size: number of barcodes added to the sketches at once
+    :param skip_undetermined: skip reads starting with neither tag instead of raising an error
+    :param barcode_length: number of bases after the tag used as barcode
+    :return: ApproximateBarcodeCounter of the forward strand and of the reverse strand
+    """
+    counter_forward = ApproximateBarcodeCounter(sketch_width, sketch_depth, hll_precision, top_k)
+    counter_reverse = ApproximateBarcodeCounter(sketch_width, sketch_depth, hll_precision, top_k)
+    forward_batch, reverse_batch = [], []
+    for name, seq, quality, comment in fastq:
+        if seq.startswith(forward_tag):
+            forward_batch.append(seq[len(forward_tag):len(forward_tag) + barcode_length])
+        elif seq.startswith(reverse_tag):
+            # Get reverse complement of reverse strand (in order to simplify search and comparisons)
+            reverse_batch.append(reverse_complement(seq[len(reverse_tag):len(reverse_tag) + barcode_length]))
+        elif not skip_undetermined:
+            raise Exception("Cannot determine the orientation of read.")
+        if len(forward_batch) >= batch_size:
+            counter_forward.add_batch(forward_batch)
+            forward_batch = []
+        if len(reverse_batch) >= batch_size:
+            counter_reverse.add_batch(reverse_batch)
+            reverse_batch = []
+    counter_forward.add_batch(forward_batch)
+    counter_reverse.add_batch(reverse_batch)
+    return counter_forward, counter_reverse
+
+
+def barcodes_dict_from_fastq(fq_file, tags, collapse_method='index', encoded=False, workers=1,
+                             checkpoint_file=None, batch_size=1000000, checkpoint_interval=10,
+                             skip_undetermined=False, metrics=None):
     """
     Read fastq file and creates two dictionaries of barcodes
-    from forward and reverse reads, and two dictionaries with
+    from forward and reverse reads, and two location stores with
     their respective x and y positions
     :param fq_file: input FastQ file
     :param tags: list containing forward and reverse strand identifiers.
+    :param collapse_method: key of COLLAPSE_METHODS used to merge barcodes with one mismatch
+    :param encoded: count 2-bit packed barcodes instead of string keyed dictionaries
+    :param workers: number of worker processes counting shards of the reads
+    :param checkpoint_file: count the reads in batches and checkpoint the counts to this file,
+        resuming from it if it exists
+    :param batch_size: number of reads per batch when checkpointing
+    :param checkpoint_interval: number of batches between checkpoints
+    :param skip_undetermined: skip reads starting with neither tag instead of raising an error
+    :param metrics: PipelineMetrics recording the counting and collapsing stages
     :return: 2 dictionaries of barcode frequencies from forward and reverse strands
-        and 2 dictionaries of barcodes and their x and y positions
+        and 2 BarcodeLocations stores of their x and y positions
     """
-    # Read fastq file
-    if fq_file.endswith('.fq') or fq_file.endswith('.gz'):
-        fastq_file = pyfastx.Fastx(fq_file, comment=True)
+    if metrics is None:
+        metrics = PipelineMetrics()
+    if encoded and workers <= 1 and checkpoint_file is None:
+        # Parse the file in blocks of bytes, without a Python object per read
+        fastq_file = fq_file
+        count_reads = count_barcode_file_encoded
+    elif checkpoint_file is not None:
+        fingerprint = {'fastq_file': os.path.abspath(fq_file), 'fastq_size': os.path.getsize(fq_file),
+                       'tags': list(tags), 'encoded': encoded, 'batch_size': batch_size,
+                       'skip_undetermined': skip_undetermined}
+        count_reads = partial(count_barcode_reads_streaming, checkpoint_file=checkpoint_file,
+                              fingerprint=fingerprint, batch_size=batch_size,
+                              checkpoint_interval=checkpoint_interval, encoded=encoded, workers=workers)
+    elif workers > 1:
+        count_reads = partial(count_barcode_reads_parallel, workers=workers, encoded=encoded)
     else:
-        # If file extension not `.fq` raise an error
-        raise NotImplementedError("File format not supported")
-    barcode_counts_fow, barcode_counts_rev, barcode_loc_fow, barcode_loc_rev = \
-        create_barcode_frequency_dict(fastq_file, forward_tag=tags[0], reverse_tag=tags[1])
+        count_reads = count_barcode_reads
+    if count_reads is not count_barcode_file_encoded:
+        fastq_file = _ReadCounter(_open_fastq(fq_file))
+    with metrics.stage('count_barcodes') as stage_metrics:
+        barcode_counts_fow, barcode_counts_rev, barcode_loc_fow, barcode_loc_rev = \
+            count_reads(fastq_file, forward_tag=tags[0], reverse_tag=tags[1], skip_undetermined=skip_undetermined)
+        # The byte parser counts the reads itself
+        reads_processed = fastq_file.n_reads if isinstance(fastq_file, _ReadCounter) else barcode_counts_fow.n_reads
+        stage_metrics['reads_processed'] = reads_processed
+        stage_metrics['forward_reads'] = barcode_loc_fow.n_reads
+        stage_metrics['reverse_reads'] = barcode_loc_rev.n_reads
+        stage_metrics['undetermined_reads'] = reads_processed - barcode_loc_fow.n_reads - barcode_loc_rev.n_reads
+        stage_metrics['unique_forward_barcodes'] = len(barcode_counts_fow)
+        stage_metrics['unique_reverse_barcodes'] = len(barcode_counts_rev)
+    # Merge barcodes with one mismatch once all the reads are counted
+    with metrics.stage('collapse_mismatches') as stage_metrics:
+        barcode_counts_fow = collapse_barcode_counts(barcode_counts_fow, collapse_method)
+        barcode_counts_rev = collapse_barcode_counts(barcode_counts_rev, collapse_method)
+        stage_metrics['unique_forward_barcodes'] = len(barcode_counts_fow)
+        stage_metrics['unique_reverse_barcodes'] = len(barcode_counts_rev)
     return barcode_counts_fow, barcode_counts_rev, barcode_loc_fow, barcode_loc_rev
 
 
+def reverse_complement_series(barcodes):
+    """
+    Find reverse complements of a series of barcodes at once
+    :param barcodes: pandas series or index of barcode strings
+    :return: reverse complements of the barcodes
+    """
+    return barcodes.str.translate(BASE_COMPLEMENT_TABLE).str[::-1]
+
+
+def approximate_barcodes_dict_from_fastq(fq_file, tags, collapse_method='index', sketch_width=2 ** 20,
+                                         sketch_depth=4, hll_precision=14, top_k=10000, skip_undetermined=False,
+                                         metrics=None, barcode_length=8):
+    """
+    Read fastq file and count the barcodes of forward and reverse reads
+    in fixed memory, then merge barcodes with one mismatch among the
+    heavy hitters only
+    :param fq_file: input FastQ file
+    :param tags: list containing forward and reverse strand identifiers.
+    :param collapse_method: key of COLLAPSE_METHODS used to merge barcodes with one mismatch
+    :param sketch_width: number of counters per row of the count-min sketch
+    :param sketch_depth: number of rows of the count-min sketch
+    :param hll_precision: number of index bits of the HyperLogLog (2^precision registers)
+    :param top_k: number of heavy hitter barcodes kept per strand
+    :param skip_undetermined: skip reads starting with neither tag instead of raising an error
+    :param metrics: PipelineMetrics recording the counting and collapsing stages
+    :param barcode_length: number of bases after the tag used as barcode
+    :return: 2 dictionaries of estimated barcode frequencies from forward and reverse strands
+        and a dictionary of the error bounds of each strand
+    """
+    if metrics is None:
+        metrics = PipelineMetrics()
+    fastq_file = _ReadCounter(_open_fastq(fq_file))
+    with metrics.stage('count_barcodes') as stage_metrics:
+        counter_fow, counter_rev = count_barcode_reads_approximate(
+            fastq_file, forward_tag=tags[0], reverse_tag=tags[1], sketch_width=sketch_width,
+            sketch_depth=sketch_depth, hll_precision=hll_precision, top_k=top_k,
+            skip_undetermined=skip_undetermined, barcode_length=barcode_length)
+        stage_metrics['reads_processed'] = fastq_file.n_reads
+        stage_metrics['forward_reads'] = counter_fow.count_min.total
+        stage_metrics['reverse_reads'] = counter_rev.count_min.total
+        stage_metrics['undetermined_reads'] = \
+            fastq_file.n_reads - counter_fow.count_min.total - counter_rev.count_min.total
+        stage_metrics['unique_forward_barcodes'] = round(counter_fow.distinct.estimate())
+        stage_metrics['unique_reverse_barcodes'] = round(counter_rev.distinct.estimate())
+    with metrics.stage('collapse_mismatches') as stage_metrics:
+        collapse_barcodes = COLLAPSE_METHODS[collapse_method]
+        barcode_counts_fow = collapse_barcodes(counter_fow.barcode_counts())
+        barcode_counts_rev = collapse_barcodes(counter_rev.barcode_counts())
+        stage_metrics['unique_forward_barcodes'] = len(barcode_counts_fow)
+        stage_metrics['unique_reverse_barcodes'] = len(barcode_counts_rev)
+    error_bounds = {'forward': counter_fow.error_bounds(), 'reverse': counter_rev.error_bounds()}
+    return barcode_counts_fow, barcode_counts_rev, error_bounds
+
+
 def summarize_barcodes(forward_dict, reverse_dict):
     """
     Summarize the frequencies of forward and reverse
@@ -138,42 +895,21 @@ def summarize_barcodes(forward_dict, reverse_dict):
     :param reverse_dict: dictionary of reverse barcodes and frequencies
     :return: CSV file containing the barcodes and their counts, sorted by depth of coverage
     """
-    # Initialize the output dataframe
-    output_data = pd.DataFrame(columns=['forward_barcode', 'forward_count', 'reverse_barcode', 'reverse_count'])
-    # Iterate over forward dict keys to match with reverse dict keys
-    for k, v in forward_dict.items():
-        if k in reverse_dict.keys():
-            row = {
-                'forward_barcode': k,
-                'forward_count': forward_dict[k],
-                'reverse_barcode': reverse_complement(k),
-                'reverse_count': reverse_dict[k]
-            }
-            output_data = pd.concat([output_data, pd.DataFrame([row])], ignore_index=True)
-        # If barcode in forward dict but not in reverse dict
-        else:
-            row = {
-                'forward_barcode': k,
-                'forward_count': forward_dict[k],
-                'reverse_barcode': None,
-                'reverse_count': None
-            }
-            output_data = pd.concat([output_data, pd.DataFrame([row])], ignore_index=True)
-    # Write all the frequencies that are in the reverse strand dictionary
-    # but not in the forward strand dictionary
-    # since reverse_dict contains reverse complements of barcodes as keys, we compare the keys directly
-    rev_dict_keys = [i for i in list(reverse_dict.keys()) if i not in list(forward_dict.keys())]
-    for k in rev_dict_keys:
-        row = {
-            'forward_barcode': None,
-            'forward_count': None,
-            'reverse_barcode': reverse_complement(k),
-            'reverse_count': reverse_dict[k]
-        }
-        output_data = pd.concat([output_data, pd.DataFrame([row])], ignore_index=True)
+    forward_counts = pd.Series(forward_dict, dtype='int64')
+    reverse_counts = pd.Series(reverse_dict, dtype='int64')
+    # Outer join of the two strands: forward barcodes first, then the barcodes
+    # only in the reverse strand dictionary (in the order of each dictionary).
+    # Since reverse_dict contains reverse complements of barcodes as keys, we compare the keys directly
+    barcodes = forward_counts.index.append(reverse_counts.index[~reverse_counts.index.isin(forward_counts.index)])
+    in_forward = barcodes.isin(forward_counts.index)
+    in_reverse = barcodes.isin(reverse_counts.index)
+    output_data = pd.DataFrame({
+        'forward_barcode': pd.Series(barcodes, dtype=object).where(in_forward, None),
+        'forward_count': forward_counts.reindex(barcodes).to_numpy(),
+        'reverse_barcode': reverse_complement_series(pd.Series(barcodes, dtype=object)).where(in_reverse, None),
+        'reverse_count': reverse_counts.reindex(barcodes).to_numpy()
+    })
     # Getting the minimum coverage between the forward and reverse strands
-    output_data[['forward_count', 'reverse_count']] = \
-        output_data[['forward_count', 'reverse_count']].apply(pd.to_numeric)
     output_data['min_count'] = output_data[['forward_count', 'reverse_count']].min(axis=1)
     # Sorting by minimum coverage
     output_data = output_data.sort_values(by='min_count')[['forward_barcode', 'forward_count',
@@ -181,40 +917,47 @@ def summarize_barcodes(forward_dict, reverse_dict):
     return output_data
 
 
-def additional_count_statistics(barcode_csv, output_path):
+def write_barcode_summary(output_data, output_path, output_format='csv', chunksize=100000):
+    """
+    Write the barcode summary table straight to disk
+    :param output_data: pandas dataframe returned by `summarize_barcodes`
+    :param output_path: output directory
+    :param output_format: 'csv' (written in chunks of rows) or 'parquet'
+    :param chunksize: number of rows formatted at a time when writing CSV
+    :return: path of the written file
+    """
+    output_file = os.path.join(output_path, 'barcode_frequencies_ascending.' + output_format)
+    if output_format == 'csv':
+        output_data.to_csv(output_file, index=False, chunksize=chunksize)
+    elif output_format == 'parquet':
+        output_data.to_parquet(output_file, index=False)
+    else:
+        raise NotImplementedError("Output format not supported")
+    return output_file
+
+
+def additional_count_statistics(barcode_csv, output_path, plot=True, add_total_reads=True, chunksize=100000):
     """
     Get the counts of total forward and reverse barcodes
     and the spread of barcode counts for each barcode
     :param barcode_csv: pandas dataframe containing FWD/REV barcodes and their respective counts
     :param output_path: output path to store plots generated
+    :param plot: also plot the distributions of the counts (the barcodes are only sampled for the plot)
+    :param add_total_reads: add the total_reads column (forward + reverse counts) to barcode_csv
+    :param chunksize: number of rows added to the running statistics at a time
     :return: Mean, variance and standard deviation of the counts
     """
-
-    print(f"Total number of forward barcodes: {barcode_csv['forward_barcode'].nunique()}\n"
-          f"Total count of forward barcodes: {barcode_csv['forward_count'].sum()}\n")
-    print(f"Total number of reverse barcodes: {barcode_csv['reverse_barcode'].nunique()}\n"
-          f"Total count of reverse barcodes: {barcode_csv['reverse_count'].sum()}\n\n")
-    barcode_csv['total_reads'] = barcode_csv[['forward_count', 'reverse_count']].sum(axis=1)
-    average_reads = np.mean(barcode_csv['total_reads'])
-    standard_deviation = np.std(barcode_csv['total_reads'])
-    variance = np.var(barcode_csv['total_reads'])
-    print(f"Mean: {average_reads}\nStandard Deviation: {standard_deviation}")
-    print(f"Variance: {variance}")
-    # Plot a histogram showing distribution of the counts in both strands
-    plt.figure(figsize=(10, 6))
-    plt.hist(barcode_csv['forward_count'].dropna(), color='blue', bins=20, alpha=0.5, label='Forward counts')
-    plt.hist(barcode_csv['reverse_count'].dropna(), color='green', bins=20, alpha=0.5, label='Reverse counts')
-    plt.legend()
-    plt.savefig(os.path.join(output_path, 'histograms_of_barcode_distributions.png'))
-    plt.gcf()
-    # Plot a bar plot showing counts per barcode
-    plt.figure(figsize=(8, 5))
-    # Randomly select 10 sample barcodes for ease of visualization
-    sub_df = barcode_csv.dropna(subset=['forward_barcode']).sample(n=10)
-    sub_df.plot(x='forward_barcode', y=['forward_count', 'reverse_count'], kind='bar', rot=45)
-    plt.subplots_adjust(bottom=0.15)
-    plt.savefig(os.path.join(output_path, 'barplot_difference_in_counts.png'))
-    plt.gcf()
+    statistics = BarcodeCountStatistics(sample_size=10 if plot else 0)
+    for start in range(0, len(barcode_csv), chunksize):
+        chunk = barcode_csv.iloc[start:start + chunksize]
+        statistics.update(chunk['forward_barcode'].to_numpy(), chunk['forward_count'].to_numpy(dtype=float),
+                          chunk['reverse_count'].to_numpy(dtype=float))
+    if add_total_reads:
+        barcode_csv['total_reads'] = barcode_csv[['forward_count', 'reverse_count']].sum(axis=1)
+    count_statistics = statistics.report()
+    if plot:
+        plot_count_statistics(statistics, output_path)
+    return count_statistics
 
 
 def main():
@@ -229,27 +972,120 @@ def main():
     parser.add_argument('-t', '--tags', nargs=2, default=['CAT', 'GTA'],
                         help='Tags specifying the forward and reverse strands (in that order) default: CAT, GTA')
     parser.add_argument('-o', '--output_path', help='Location of output file path')
+    parser.add_argument('--collapse_method', choices=sorted(COLLAPSE_METHODS), default='index',
+                        help='Method used to merge barcodes with one mismatch into the more frequent barcode: '
+                             'index (masked-key lookup) or pairwise (compare every pair) default: index')
+    parser.add_argument('--encoded', help='Count barcodes packed into integers (2 bits per base) '
+                                          'instead of string keyed dictionaries, parsing the reads in blocks '
+                                          'of bytes and merging barcodes with one mismatch on the packed barcodes '
+                                          '(same result as --collapse_method)',
+                        action='store_true')
     parser.add_argument('--additional_statistics', help='Calculate additional statistics to get distribution of counts'
                                                         'across barcodes',
                         action='store_true')
+    parser.add_argument('--no_plots', help='Only print the additional statistics, without plotting them',
+                        action='store_true')
+    parser.add_argument('--no_total_reads', help='Do not add the total_reads column to the output with the '
+                                                 'additional statistics',
+                        action='store_true')
+    parser.add_argument('--output_format', choices=['csv', 'parquet'], default='csv',
+                        help='Format of the barcode frequencies file default: csv')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of worker processes counting shards of the reads default: 1')
+    parser.add_argument('--checkpoint_file', help='Count the reads in batches and checkpoint the running counts '
+                                                  'to this file, resuming from it if it exists (the reads already '
+                                                  'counted are parsed again, but not counted)')
+    parser.add_argument('--batch_size', type=int, default=1000000,
+                        help='Number of reads per batch when checkpointing default: 1000000')
+    parser.add_argument('--checkpoint_interval', type=int, default=10,
+                        help='Number of batches between checkpoints, each appending the counts of its batches '
+                             'to the checkpoint file default: 10')
+    parser.add_argument('--approximate', help='Count barcodes in fixed memory with sketches, keeping only the '
+                                              'top-K barcodes of each strand, and write the error bounds to '
+                                              'barcode_count_error_bounds.json',
+                        action='store_true')
+    parser.add_argument('--sketch_width', type=int, default=2 ** 20,
+                        help='Counters per row of the count-min sketch (--approximate) default: 1048576')
+    parser.add_argument('--sketch_depth', type=int, default=4,
+                        help='Rows of the count-min sketch (--approximate) default: 4')
+    parser.add_argument('--hll_precision', type=int, default=14,
+                        help='Index bits of the HyperLogLog distinct counter (--approximate) default: 14')
+    parser.add_argument('--top_k', type=int, default=10000,
+                        help='Number of most frequent barcodes kept per strand (--approximate) default: 10000')
+    parser.add_argument('--barcode_length', type=int,
+                        help='Number of bases after the tag used as barcode (--approximate, e.g. for barcodes '
+                             'too long to count exactly) default: 8')
+    parser.add_argument('--counts_file', help='Also write the forward and reverse counts, before merging barcodes '
+                                              'with one mismatch, to this binary file (see merge_barcode_runs.py)')
+    parser.add_argument('--density_file', help='Write the matrix of reads per grid cell of the flow cell '
+                                               'to this .csv or .npy file')
+    parser.add_argument('--grid_cell_size', type=float, default=1000.0,
+                        help='Width and height of the grid cells of the density matrix default: 1000')
+    parser.add_argument('--density_distinct_barcodes', help='Count distinct barcodes per grid cell instead of reads',
+                        action='store_true')
+    parser.add_argument('--skip_undetermined', help='Skip reads starting with neither tag instead of stopping '
+                                                    'with an error', action='store_true')
     # Calculate time taken to run the code
     parser.add_argument('--calculate_time', help='Calculate time taken to run the script',
                         action='store_true')
+    parser.add_argument('--metrics_file', help='Write wall/CPU time, peak memory and counts of each stage '
+                                               'to this .json or .csv file')
+    parser.add_argument('--profile_file', help='Profile the stages with cProfile and write the statistics '
+                                               'to this file (readable with pstats)')
 
     args = parser.parse_args()
+    if args.approximate and (args.encoded or args.workers > 1 or args.checkpoint_file or args.counts_file or
+                             args.density_file):
+        parser.error("--approximate cannot be combined with --encoded, --workers, --checkpoint_file, "
+                     "--counts_file or --density_file")
+    if args.barcode_length is not None and not args.approximate:
+        parser.error("--barcode_length is only supported with --approximate")
     print("Initiating script...\n\n")
-    start = time.time()
+    metrics = PipelineMetrics(profile=args.profile_file is not None)
     print("Creating barcode dictionary...\n\n")
-    fow, rev, fow_loc, rev_loc = barcodes_dict_from_fastq(args.fastq_file, args.tags)
+    if args.approximate:
+        fow, rev, error_bounds = approximate_barcodes_dict_from_fastq(
+            args.fastq_file, args.tags, args.collapse_method, args.sketch_width, args.sketch_depth,
+            args.hll_precision, args.top_k, args.skip_undetermined, metrics,
+            8 if args.barcode_length is None else args.barcode_length)
+        with open(os.path.join(args.output_path, 'barcode_count_error_bounds.json'), 'w') as f:
+            json.dump(error_bounds, f, indent=2)
+    else:
+        fow, rev, fow_loc, rev_loc = barcodes_dict_from_fastq(args.fastq_file, args.tags, args.collapse_method,
+                                                              args.encoded, args.workers, args.checkpoint_file,
+                                                              args.batch_size, args.checkpoint_interval,
+                                                              args.skip_undetermined, metrics)
     print("Writing counts to csv file...\n\n")
-    output_data = summarize_barcodes(fow, rev)
+    with metrics.stage('summarize_barcodes') as stage_metrics:
+        output_data = summarize_barcodes(fow, rev)
+        stage_metrics['rows'] = len(output_data)
     if args.additional_statistics:
         print("Printing the counts and spread of the barcodes...\n\n")
-        additional_count_statistics(output_data, args.output_path)
-    output_data.to_csv(os.path.join(args.output_path, 'barcode_frequencies_ascending.csv'), index=False)
+        with metrics.stage('additional_count_statistics'):
+            additional_count_statistics(output_data, args.output_path, plot=not args.no_plots,
+                                        add_total_reads=not args.no_total_reads)
+    with metrics.stage('write_output'):
+        write_barcode_summary(output_data, args.output_path, args.output_format)
+    if args.counts_file is not None:
+        # The location stores hold one entry per read, i.e. the counts before merging mismatches
+        with metrics.stage('write_counts_file'):
+            write_count_file(args.counts_file, fow_loc.counts(), rev_loc.counts(), args.tags,
+                             metadata={'fastq_file': os.path.abspath(args.fastq_file)})
+    if args.density_file is not None:
+        print("Writing the density of reads on the flow cell...\n\n")
+        with metrics.stage('spatial_density'):
+            grid_index = BarcodeGridIndex([fow_loc, rev_loc], cell_size=args.grid_cell_size)
+            grid_index.write_density(args.density_file, distinct_barcodes=args.density_distinct_barcodes)
+    if args.checkpoint_file is not None:
+        # The output is written, the counts no longer need to be resumed
+        os.remove(args.checkpoint_file)
+    if args.metrics_file is not None:
+        metrics.write(args.metrics_file)
+    if args.profile_file is not None:
+        metrics.dump_profile(args.profile_file)
     print("\n\nComplete.\n")
     if args.calculate_time:
-        print(f"Time taken to run the code: {round(time.time() - start, 2)} seconds")
+        print(f"Time taken to run the code: {round(metrics.elapsed_seconds, 2)} seconds")
 
 
 if __name__ == '__main__':
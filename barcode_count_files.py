@@ -0,0 +1,161 @@
+import json
+import struct
+import numpy as np
+from barcode_encoding import code_dtype, encode_barcodes, decode_barcodes
+
+# File layout: magic, little-endian uint64 length of the JSON header, JSON header,
+# then the arrays, each starting at an offset aligned to ARRAY_ALIGNMENT bytes
+# so that they can be memory-mapped directly.
+MAGIC = b'BCCOUNT1'
+ARRAY_ALIGNMENT = 64
+STRANDS = ('forward', 'reverse')
+
+
+def _aligned(offset):
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+def _encode_counts(barcode_counts, barcode_length):
+    """
+    Split a barcode count dictionary into sorted packed barcodes with their counts,
+    and the barcodes that cannot be packed (e.g. containing N)
+    :param barcode_counts: dictionary of barcodes and counts
+    :param barcode_length: number of bases in a barcode
+    :return: sorted array of packed barcodes, array of counts, dictionary of other barcodes and counts
+    """
+    barcodes = list(barcode_counts)
+    counts = np.fromiter(barcode_counts.values(), dtype=np.int64, count=len(barcodes))
+    packed, valid = encode_barcodes(barcodes, barcode_length)
+    order = np.argsort(packed[valid], kind='stable')
+    other_counts = {barcodes[i]: int(counts[i]) for i in np.flatnonzero(~valid)}
+    return packed[valid][order], counts[valid][order], other_counts
+
+
+def write_count_file(count_file, forward_counts, reverse_counts, tags, barcode_length=8, metadata=None):
+    """
+    Write forward and reverse barcode counts (before merging barcodes
+    with one mismatch) to a compact, memory-mappable binary file
+    :param count_file: output path
+    :param forward_counts: dictionary of forward barcodes and counts
+    :param reverse_counts: dictionary of reverse barcodes (reverse complemented) and counts
+    :param tags: forward and reverse strand identifiers
+    :param barcode_length: number of bases in a barcode
+    :param metadata: optional dictionary stored in the header (e.g. the source fastq file)
+    """
+    header = {'tags': list(tags), 'barcode_length': barcode_length,
+              'code_dtype': code_dtype(barcode_length).str, 'metadata': metadata or {}, 'arrays': {}}
+    arrays = []
+    for strand, barcode_counts in zip(STRANDS, (forward_counts, reverse_counts)):
+        codes, counts, other_counts = _encode_counts(barcode_counts, barcode_length)
+        header[f'{strand}_other'] = other_counts
+        arrays += [(f'{strand}_codes', codes), (f'{strand}_counts', counts)]
+    # The array offsets are stored in the header, whose length depends on them,
+    # so they are counted from the end of the (padded) header
+    for name, values in arrays:
+        header['arrays'][name] = {'dtype': values.dtype.str, 'length': len(values)}
+    relative_offset = 0
+    for name, values in arrays:
+        header['arrays'][name]['offset'] = relative_offset
+        relative_offset = _aligned(relative_offset + values.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+    with open(count_file, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, values in arrays:
+            f.write(b'\0' * (data_start + header['arrays'][name]['offset'] - f.tell()))
+            f.write(values.tobytes())
+
+
+def read_count_file(count_file):
+    """
+    Open a binary count file written by `write_count_file`
+    :param count_file: input path
+    :return: header dictionary and dictionary of read-only memory-mapped arrays
+    """
+    with open(count_file, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{count_file} is not a barcode count file.")
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = _aligned(len(MAGIC) + 8 + header_length)
+    arrays = {}
+    for name, description in header['arrays'].items():
+        if description['length'] == 0:
+            arrays[name] = np.empty(0, dtype=description['dtype'])
+            continue
+        arrays[name] = np.memmap(count_file, dtype=description['dtype'], mode='r',
+                                 offset=data_start + description['offset'], shape=(description['length'],))
+    return header, arrays
+
+
+def merge_count_arrays(code_arrays, count_arrays, chunksize=2 ** 20):
+    """
+    Streaming k-way merge of sorted arrays of unique packed barcodes (e.g. memory-mapped),
+    summing the counts of equal barcodes. At most `chunksize` barcodes of every array
+    are read into memory at a time.
+    :param code_arrays: list of sorted arrays of unique packed barcodes
+    :param count_arrays: list of arrays of the matching counts
+    :param chunksize: number of barcodes read from an array at a time
+    :return: generator of (sorted array of packed barcodes, array of their summed counts)
+        blocks, in barcode order, each barcode appearing in a single block
+    """
+    positions = [0] * len(code_arrays)
+    buffered = [(codes[:0], counts[:0]) for codes, counts in zip(code_arrays, count_arrays)]
+    while True:
+        # Refill the inputs whose buffered barcodes were all merged
+        for i, (codes, counts) in enumerate(zip(code_arrays, count_arrays)):
+            if not len(buffered[i][0]) and positions[i] < len(codes):
+                end = positions[i] + chunksize
+                buffered[i] = (np.asarray(codes[positions[i]:end]), np.asarray(counts[positions[i]:end]))
+                positions[i] = min(end, len(codes))
+        if not any(len(codes) for codes, _ in buffered):
+            return
+        # Barcodes up to the smallest last buffered barcode of the inputs with more to read
+        # cannot appear in their later chunks, so they are merged now
+        unread = [buffered[i][0][-1] for i, codes in enumerate(code_arrays) if positions[i] < len(codes)]
+        block_codes, block_counts = [], []
+        for i, (codes, counts) in enumerate(buffered):
+            end = len(codes) if not unread else np.searchsorted(codes, min(unread), side='right')
+            block_codes.append(codes[:end])
+            block_counts.append(counts[:end])
+            buffered[i] = (codes[end:], counts[end:])
+        codes = np.concatenate(block_codes)
+        counts = np.concatenate(block_counts)
+        order = np.argsort(codes, kind='stable')
+        codes, counts = codes[order], counts[order]
+        run_starts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]]))
+        yield codes[run_starts], np.add.reduceat(counts, run_starts)
+
+
+def merge_count_files(count_files, chunksize=2 ** 20):
+    """
+    Merge the barcode counts of several binary count files (e.g. one per lane),
+    streaming through their memory-mapped arrays with `merge_count_arrays`
+    :param count_files: list of paths written by `write_count_file`
+    :param chunksize: number of barcodes read from a file's array at a time
+    :return: header of the first file, and dictionaries of the merged forward and reverse
+        barcode counts, in barcode order
+    """
+    opened = [read_count_file(count_file) for count_file in count_files]
+    if not opened:
+        raise ValueError("No count files to merge.")
+    first_header = opened[0][0]
+    for count_file, (header, _) in zip(count_files, opened):
+        if header['tags'] != first_header['tags'] or header['barcode_length'] != first_header['barcode_length']:
+            raise ValueError(f"{count_file} was counted with different tags or barcode length "
+                             f"than {count_files[0]}.")
+    barcode_length = first_header['barcode_length']
+    merged = []
+    for strand in STRANDS:
+        barcode_counts = {}
+        for codes, counts in merge_count_arrays([arrays[f'{strand}_codes'] for _, arrays in opened],
+                                                [arrays[f'{strand}_counts'] for _, arrays in opened],
+                                                chunksize=chunksize):
+            barcode_counts.update(zip(decode_barcodes(codes, barcode_length), counts.tolist()))
+        for header, _ in opened:
+            for _barcode, _count in sorted(header[f'{strand}_other'].items()):
+                barcode_counts[_barcode] = barcode_counts.get(_barcode, 0) + _count
+        merged.append(barcode_counts)
+    return first_header, merged[0], merged[1]
@@ -0,0 +1,97 @@
+import numpy as np
+
+# 2-bit code of each base. The order is chosen so that the complement
+# of a base is `3 - code`, i.e. the code with both bits flipped,
+# and so that sorting packed codes sorts the barcodes alphabetically.
+BASES = 'ACGT'
+INVALID_CODE = 4
+_ASCII_TO_CODE = np.full(256, INVALID_CODE, dtype=np.uint8)
+for _code, _base in enumerate(BASES):
+    _ASCII_TO_CODE[ord(_base)] = _code
+_CODE_TO_ASCII = np.frombuffer(BASES.encode('ascii'), dtype=np.uint8)
+
+
+def code_dtype(barcode_length):
+    """
+    Smallest unsigned integer type holding a packed barcode
+    :param barcode_length: number of bases in a barcode
+    :return: numpy dtype
+    """
+    if barcode_length <= 8:
+        return np.dtype(np.uint16)
+    if barcode_length <= 16:
+        return np.dtype(np.uint32)
+    if barcode_length <= 32:
+        return np.dtype(np.uint64)
+    raise ValueError("Barcodes longer than 32 bases cannot be packed into an integer.")
+
+
+def _shifts(barcode_length, dtype):
+    # First base goes into the most significant bits
+    return (2 * np.arange(barcode_length - 1, -1, -1)).astype(dtype)
+
+
+def encode_barcodes(barcodes, barcode_length=8):
+    """
+    Pack barcodes into integers with 2 bits per base
+    :param barcodes: list of barcode strings
+    :param barcode_length: number of bases in a barcode
+    :return: array of packed barcodes and a boolean array marking the barcodes
+        that could be packed (exactly `barcode_length` bases, only A/C/G/T).
+        Packed values of barcodes that could not be packed are undefined.
+    """
+    packed = np.zeros(len(barcodes), dtype=code_dtype(barcode_length))
+    valid = np.fromiter((len(b) == barcode_length for b in barcodes), dtype=bool, count=len(barcodes))
+    if not valid.any():
+        return packed, valid
+    joined = ''.join(b for b, ok in zip(barcodes, valid) if ok).encode('ascii')
+    packed[valid], valid[valid] = pack_bases(np.frombuffer(joined, dtype=np.uint8).reshape(-1, barcode_length),
+                                             barcode_length)
+    return packed, valid
+
+
+def pack_bases(bases, barcode_length=8):
+    """
+    Pack rows of ASCII bases (e.g. cut from a buffer of reads) into integers with 2 bits per base
+    :param bases: uint8 array of shape (n, barcode_length)
+    :param barcode_length: number of bases in a barcode
+    :return: array of packed barcodes and a boolean array marking the rows of only A/C/G/T.
+        Packed values of the other rows are undefined.
+    """
+    dtype = code_dtype(barcode_length)
+    codes = _ASCII_TO_CODE[bases]
+    only_bases = (codes != INVALID_CODE).all(axis=1)
+    codes = np.where(only_bases[:, None], codes, 0).astype(dtype)
+    return np.bitwise_or.reduce(codes << _shifts(barcode_length, dtype), axis=1), only_bases
+
+
+def decode_barcodes(packed, barcode_length=8):
+    """
+    Unpack 2-bit packed barcodes back into strings
+    :param packed: array of packed barcodes
+    :param barcode_length: number of bases in a barcode
+    :return: list of barcode strings
+    """
+    packed = np.asarray(packed, dtype=code_dtype(barcode_length))
+    if packed.size == 0:
+        return []
+    codes = (packed[:, None] >> _shifts(barcode_length, packed.dtype)) & 3
+    letters = np.ascontiguousarray(_CODE_TO_ASCII[codes])
+    return [b.decode('ascii') for b in letters.view(f'S{barcode_length}').ravel()]
+
+
+def reverse_complement_codes(packed, barcode_length=8):
+    """
+    Reverse complement of 2-bit packed barcodes using bit operations only
+    :param packed: array of packed barcodes
+    :param barcode_length: number of bases in a barcode
+    :return: array of packed reverse complements
+    """
+    packed = np.asarray(packed, dtype=code_dtype(barcode_length))
+    # Complement every base by flipping both of its bits
+    complement = packed ^ packed.dtype.type((1 << (2 * barcode_length)) - 1)
+    reverse = np.zeros_like(complement)
+    for i in range(barcode_length):
+        reverse |= ((complement >> packed.dtype.type(2 * i)) & packed.dtype.type(3)) \
+                   << packed.dtype.type(2 * (barcode_length - 1 - i))
+    return reverse
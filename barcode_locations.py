@@ -0,0 +1,257 @@
+import array
+import numpy as np
+
+
+class BarcodeLocations(object):
+    """
+    Compact store of the X/Y locations of the reads of every barcode.
+    Locations are appended to growable float32 buffers (12 bytes per read
+    with the barcode ID) and grouped by barcode ID on first access, after
+    which each barcode's locations are a zero-copy (n, 2) float32 view.
+    """
+
+    def __init__(self):
+        # Barcode -> ID, in the order the barcodes were first seen
+        self._barcode_ids = {}
+        # Reads added since the locations were last grouped
+        self._buffer_ids = array.array('i')
+        self._buffer_x = array.array('f')
+        self._buffer_y = array.array('f')
+        # Locations sorted by barcode ID, barcode i owns rows offsets[i]:offsets[i + 1]
+        self._locations = np.empty((0, 2), dtype=np.float32)
+        self._offsets = np.zeros(1, dtype=np.int64)
+
+    def append(self, barcode, x_location, y_location):
+        """
+        Add the location of one read
+        :param barcode: barcode of the read
+        :param x_location: X position of the read
+        :param y_location: Y position of the read
+        """
+        self._buffer_ids.append(self._barcode_ids.setdefault(barcode, len(self._barcode_ids)))
+        self._buffer_x.append(x_location)
+        self._buffer_y.append(y_location)
+
+    def extend_batch(self, barcodes, barcode_indices, x_locations, y_locations):
+        """
+        Add the locations of a batch of reads at once
+        :param barcodes: list of the distinct barcodes of the batch, in the order of their first read
+        :param barcode_indices: int array of the index in `barcodes` of every read's barcode
+        :param x_locations: array of the X positions of the reads
+        :param y_locations: array of the Y positions of the reads
+        """
+        id_map = np.array([self._barcode_ids.setdefault(_barcode, len(self._barcode_ids)) for _barcode in barcodes],
+                          dtype=np.int32)
+        self._buffer_ids.frombytes(id_map[barcode_indices].tobytes())
+        self._buffer_x.frombytes(np.asarray(x_locations, dtype=np.float32).tobytes())
+        self._buffer_y.frombytes(np.asarray(y_locations, dtype=np.float32).tobytes())
+
+    def extend(self, other):
+        """
+        Add all the locations of another store after the locations of this one
+        :param other: BarcodeLocations to add
+        """
+        other._group()
+        id_map = np.array([self._barcode_ids.setdefault(_barcode, len(self._barcode_ids))
+                           for _barcode in other._barcode_ids], dtype=np.int32)
+        ids = np.repeat(id_map, np.diff(other._offsets))
+        self._buffer_ids.frombytes(ids.tobytes())
+        self._buffer_x.frombytes(np.ascontiguousarray(other._locations[:, 0]).tobytes())
+        self._buffer_y.frombytes(np.ascontiguousarray(other._locations[:, 1]).tobytes())
+
+    def rename_barcodes(self, rename):
+        """
+        Re-key the store, e.g. on the reverse complements of the barcodes
+        :param rename: function mapping every barcode to a distinct new barcode
+        """
+        self._barcode_ids = {rename(_barcode): _id for _barcode, _id in self._barcode_ids.items()}
+
+    def _group(self):
+        # Merge the buffered reads into the grouped locations with a stable
+        # sort, so each barcode's locations stay in the order they were added
+        if not self._buffer_ids:
+            return
+        n_barcodes = len(self._barcode_ids)
+        grouped_ids = np.repeat(np.arange(len(self._offsets) - 1, dtype=np.int32), np.diff(self._offsets))
+        ids = np.concatenate([grouped_ids, np.frombuffer(self._buffer_ids, dtype=np.int32)])
+        buffered = np.column_stack([np.frombuffer(self._buffer_x, dtype=np.float32),
+                                    np.frombuffer(self._buffer_y, dtype=np.float32)])
+        order = np.argsort(ids, kind='stable')
+        self._locations = np.concatenate([self._locations, buffered])[order]
+        self._offsets = np.zeros(n_barcodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ids, minlength=n_barcodes), out=self._offsets[1:])
+        self._buffer_ids = array.array('i')
+        self._buffer_x = array.array('f')
+        self._buffer_y = array.array('f')
+
+    def __getitem__(self, barcode):
+        """
+        :param barcode: barcode to look up
+        :return: (n, 2) float32 view of the X/Y locations of the barcode's reads
+        """
+        self._group()
+        _id = self._barcode_ids[barcode]
+        return self._locations[self._offsets[_id]:self._offsets[_id + 1]]
+
+    def get(self, barcode, default=None):
+        return self[barcode] if barcode in self._barcode_ids else default
+
+    def __contains__(self, barcode):
+        return barcode in self._barcode_ids
+
+    def __len__(self):
+        return len(self._barcode_ids)
+
+    def __iter__(self):
+        return iter(self._barcode_ids)
+
+    def keys(self):
+        return self._barcode_ids.keys()
+
+    def values(self):
+        return (self[_barcode] for _barcode in self._barcode_ids)
+
+    def items(self):
+        return ((_barcode, self[_barcode]) for _barcode in self._barcode_ids)
+
+    def grouped(self):
+        """
+        :return: list of barcodes (in ID order), (n, 2) float32 array of all locations
+            sorted by barcode ID, and offsets of each barcode's rows
+        """
+        self._group()
+        return list(self._barcode_ids), self._locations, self._offsets
+
+    def counts(self):
+        """
+        :return: dictionary of barcodes and their number of reads
+        """
+        self._group()
+        return dict(zip(self._barcode_ids, np.diff(self._offsets).tolist()))
+
+    @property
+    def n_reads(self):
+        return len(self._locations) + len(self._buffer_ids)
+
+    @property
+    def nbytes(self):
+        return self._locations.nbytes + self._offsets.nbytes + \
+            self._buffer_ids.itemsize * len(self._buffer_ids) * 3
+
+
+class BarcodeGridIndex(object):
+    """
+    Uniform grid index over the read locations of one or more BarcodeLocations
+    stores (e.g. both strands), for rectangle/radius queries and per-cell counts.
+    Reads are sorted by grid cell, so a query only scans the cells it overlaps.
+    """
+
+    def __init__(self, location_stores, cell_size=1000.0, origin=None):
+        """
+        :param location_stores: list of BarcodeLocations
+        :param cell_size: width and height of a grid cell, in location units
+        :param origin: (x, y) of the corner of the first cell, default: smallest X and Y
+        """
+        self.cell_size = float(cell_size)
+        self._barcode_ids = {}
+        ids, locations = [], []
+        for store in location_stores:
+            barcodes, store_locations, offsets = store.grouped()
+            id_map = np.array([self._barcode_ids.setdefault(_barcode, len(self._barcode_ids))
+                               for _barcode in barcodes], dtype=np.int32)
+            ids.append(np.repeat(id_map, np.diff(offsets)))
+            locations.append(store_locations)
+        self.barcodes = list(self._barcode_ids)
+        ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.int32)
+        locations = np.concatenate(locations) if locations else np.empty((0, 2), dtype=np.float32)
+        if origin is None:
+            origin = locations.min(axis=0) if len(locations) else (0.0, 0.0)
+        self.origin = (float(origin[0]), float(origin[1]))
+        cells_x, cells_y = self._cell_coordinates(locations[:, 0], locations[:, 1])
+        if (cells_x < 0).any() or (cells_y < 0).any():
+            raise ValueError("Read locations found before the origin of the grid.")
+        self.shape = (int(cells_y.max()) + 1 if len(locations) else 0,
+                      int(cells_x.max()) + 1 if len(locations) else 0)
+        cells = cells_y * self.shape[1] + cells_x
+        order = np.argsort(cells, kind='stable')
+        self._ids = ids[order]
+        self._locations = locations[order]
+        self._cells = cells[order]
+        self._offsets = np.zeros(self.shape[0] * self.shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self.shape[0] * self.shape[1]), out=self._offsets[1:])
+
+    def _cell_coordinates(self, x_locations, y_locations):
+        cells_x = np.floor((np.asarray(x_locations, dtype=np.float64) - self.origin[0]) / self.cell_size)
+        cells_y = np.floor((np.asarray(y_locations, dtype=np.float64) - self.origin[1]) / self.cell_size)
+        return cells_x.astype(np.int64), cells_y.astype(np.int64)
+
+    def _reads_in_rectangle(self, x_min, y_min, x_max, y_max):
+        # Indices of the reads inside the rectangle, scanning only the overlapping cells
+        if not len(self._locations) or x_min > x_max or y_min > y_max:
+            return np.empty(0, dtype=np.int64)
+        cells_x, cells_y = self._cell_coordinates([x_min, x_max], [y_min, y_max])
+        cell_x_min, cell_x_max = np.clip(cells_x, 0, self.shape[1] - 1)
+        cell_y_min, cell_y_max = np.clip(cells_y, 0, self.shape[0] - 1)
+        candidates = np.concatenate([
+            np.arange(self._offsets[cell_y * self.shape[1] + cell_x_min],
+                      self._offsets[cell_y * self.shape[1] + cell_x_max + 1])
+            for cell_y in range(cell_y_min, cell_y_max + 1)])
+        x_locations, y_locations = self._locations[candidates, 0], self._locations[candidates, 1]
+        inside = (x_locations >= x_min) & (x_locations <= x_max) & (y_locations >= y_min) & (y_locations <= y_max)
+        return candidates[inside]
+
+    def _barcode_read_counts(self, reads):
+        counts = np.bincount(self._ids[reads], minlength=len(self.barcodes))
+        return {self.barcodes[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+
+    def query_rectangle(self, x_min, y_min, x_max, y_max):
+        """
+        Barcodes of the reads inside a rectangle (bounds included)
+        :return: dictionary of barcodes and their number of reads in the rectangle
+        """
+        return self._barcode_read_counts(self._reads_in_rectangle(x_min, y_min, x_max, y_max))
+
+    def query_radius(self, x_location, y_location, radius):
+        """
+        Barcodes of the reads within a distance of a point
+        :return: dictionary of barcodes and their number of reads in the circle
+        """
+        reads = self._reads_in_rectangle(x_location - radius, y_location - radius,
+                                         x_location + radius, y_location + radius)
+        distances = np.hypot(self._locations[reads, 0] - x_location, self._locations[reads, 1] - y_location)
+        return self._barcode_read_counts(reads[distances <= radius])
+
+    def read_density(self):
+        """
+        :return: (cells in Y, cells in X) matrix of the number of reads per cell
+        """
+        return np.diff(self._offsets).reshape(self.shape)
+
+    def barcode_density(self):
+        """
+        :return: (cells in Y, cells in X) matrix of the number of distinct barcodes per cell
+        """
+        cell_barcodes = np.unique(self._cells * max(len(self.barcodes), 1) + self._ids)
+        return np.bincount(cell_barcodes // max(len(self.barcodes), 1),
+                           minlength=self.shape[0] * self.shape[1]).reshape(self.shape)
+
+    def barcode_cell_counts(self, barcode):
+        """
+        :param barcode: barcode to look up
+        :return: (cells in Y, cells in X) matrix of the number of reads of the barcode per cell
+        """
+        reads = self._ids == self._barcode_ids[barcode]
+        return np.bincount(self._cells[reads], minlength=self.shape[0] * self.shape[1]).reshape(self.shape)
+
+    def write_density(self, density_file, distinct_barcodes=False):
+        """
+        Write the binned density matrix, as `.npy` or as CSV (one row per Y cell)
+        :param density_file: output path
+        :param distinct_barcodes: write distinct barcodes per cell instead of reads per cell
+        """
+        density = self.barcode_density() if distinct_barcodes else self.read_density()
+        if density_file.endswith('.npy'):
+            np.save(density_file, density)
+        else:
+            np.savetxt(density_file, density, fmt='%d', delimiter=',',
+                       header=f"origin_x={self.origin[0]},origin_y={self.origin[1]},cell_size={self.cell_size}")
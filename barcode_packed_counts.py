@@ -0,0 +1,194 @@
+from collections import defaultdict
+from collections.abc import Mapping
+import numpy as np
+from barcode_encoding import BASES, code_dtype, encode_barcodes, decode_barcodes
+
+# First-read index of barcodes not seen yet
+_UNSEEN = np.iinfo(np.int64).max
+
+
+class PackedBarcodeCounts(Mapping):
+    """
+    Read counts of the barcodes of one strand, kept as a dense array indexed
+    by the 2-bit packed barcode, plus a side dictionary for barcodes that
+    cannot be packed (containing N, or cut short by the end of the read).
+    Reads as a mapping of barcode strings to counts, in the order the barcodes
+    were first seen like the string keyed dictionaries; barcodes are decoded
+    only when read that way, and `collapse` merges them on the packed codes.
+    """
+
+    def __init__(self, barcode_length=8):
+        self.barcode_length = barcode_length
+        self.counts = np.zeros(4 ** barcode_length, dtype=np.int64)
+        # Index of the first read of every packed barcode
+        self.first_seen = np.full(4 ** barcode_length, _UNSEEN, dtype=np.int64)
+        # Unpackable barcode -> [count, index of its first read]
+        self.side_counts = {}
+        # Reads the read indices count from, both strands and undetermined reads included
+        self.n_reads = 0
+
+    def add(self, codes, counts, first_reads):
+        """
+        Count a batch of packed barcodes
+        :param codes: array of distinct packed barcodes
+        :param counts: int64 array of their read counts
+        :param first_reads: int64 array of the index of the first read of each
+        """
+        codes = codes.astype(np.int64)
+        self.counts[codes] += counts
+        self.first_seen[codes] = np.minimum(self.first_seen[codes], first_reads)
+
+    def add_side(self, barcodes, read_indices):
+        """
+        Count barcodes that cannot be packed, one read each
+        :param barcodes: list of barcode strings
+        :param read_indices: list of the indices of their reads
+        """
+        for _barcode, read_index in zip(barcodes, read_indices):
+            if _barcode not in self.side_counts:
+                self.side_counts[_barcode] = [0, read_index]
+            self.side_counts[_barcode][0] += 1
+
+    def merge(self, other):
+        """
+        Add the counts of the reads following this object's reads
+        :param other: PackedBarcodeCounts of the same barcode length
+        """
+        self.counts += other.counts
+        seen = other.first_seen != _UNSEEN
+        self.first_seen[seen] = np.minimum(self.first_seen[seen], other.first_seen[seen] + self.n_reads)
+        for _barcode, (count, first_read) in other.side_counts.items():
+            if _barcode not in self.side_counts:
+                self.side_counts[_barcode] = [0, first_read + self.n_reads]
+            self.side_counts[_barcode][0] += count
+        self.n_reads += other.n_reads
+
+    def _observed(self):
+        # Packed barcodes with reads, and (first read, barcode, count) of every barcode in the order first seen
+        codes = np.flatnonzero(self.counts)
+        entries = list(zip(self.first_seen[codes].tolist(),
+                           decode_barcodes(codes.astype(code_dtype(self.barcode_length)), self.barcode_length)
+                           if len(codes) else [],
+                           self.counts[codes].tolist()))
+        entries.extend((first_read, _barcode, count) for _barcode, (count, first_read) in self.side_counts.items())
+        entries.sort()
+        return entries
+
+    def __getitem__(self, barcode):
+        if barcode in self.side_counts:
+            return self.side_counts[barcode][0]
+        if len(barcode) == self.barcode_length and set(barcode) <= set(BASES):
+            count = int(self.counts[int(encode_barcodes([barcode], self.barcode_length)[0][0])])
+            if count:
+                return count
+        raise KeyError(barcode)
+
+    def __iter__(self):
+        return iter([_barcode for _, _barcode, _ in self._observed()])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.counts)) + len(self.side_counts)
+
+    def values(self):
+        return [count for _, _, count in self._observed()]
+
+    def items(self):
+        return [(_barcode, count) for _, _barcode, count in self._observed()]
+
+    def __getstate__(self):
+        # Only the observed barcodes, the dense arrays are mostly zeros
+        codes = np.flatnonzero(self.counts)
+        return {'barcode_length': self.barcode_length, 'codes': codes, 'counts': self.counts[codes],
+                'first_seen': self.first_seen[codes], 'side_counts': self.side_counts, 'n_reads': self.n_reads}
+
+    def __setstate__(self, state):
+        self.__init__(state['barcode_length'])
+        self.counts[state['codes']] = state['counts']
+        self.first_seen[state['codes']] = state['first_seen']
+        self.side_counts = state['side_counts']
+        self.n_reads = state['n_reads']
+
+    def _code_neighbors(self, codes, node_of_code):
+        # Adjacency lists (CSR) of the packed barcodes one mismatch apart: flipping
+        # the 2 bits of base i with 1, 2 or 3 gives the 3 other bases at i
+        sources, targets = [], []
+        for position in range(self.barcode_length):
+            for flip in (1, 2, 3):
+                neighbors = node_of_code[codes ^ (flip << 2 * (self.barcode_length - 1 - position))]
+                observed = neighbors >= 0
+                sources.append(np.flatnonzero(observed))
+                targets.append(neighbors[observed])
+        sources, targets = np.concatenate(sources), np.concatenate(targets)
+        offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(codes)), out=offsets[1:])
+        return offsets.tolist(), targets[np.argsort(sources, kind='stable')].tolist()
+
+    def _side_neighbors(self, side, node_of_code, n_codes):
+        # Neighbors of the unpackable barcodes: other unpackable barcodes sharing a
+        # barcode with one position masked out, and for full length barcodes with a
+        # single non-ACGT base, the packed barcodes with any base at that position
+        neighbors = defaultdict(list)
+        mismatch_index = defaultdict(list)
+        single_others = []
+        for node, _barcode in enumerate(side, n_codes):
+            for i in range(len(_barcode)):
+                mismatch_index[(i, _barcode[:i] + _barcode[i + 1:])].append(node)
+            others = [i for i, base in enumerate(_barcode) if base not in BASES]
+            if len(_barcode) == self.barcode_length and len(others) == 1:
+                i = others[0]
+                single_others.append((node, i, _barcode[:i] + 'A' + _barcode[i + 1:]))
+        packed, _ = encode_barcodes([_barcode for _, _, _barcode in single_others], self.barcode_length)
+        for (node, i, _), code in zip(single_others, packed.tolist()):
+            for base in range(4):
+                code_node = int(node_of_code[code | base << 2 * (self.barcode_length - 1 - i)])
+                if code_node >= 0:
+                    neighbors[node].append(code_node)
+                    neighbors[code_node].append(node)
+        for nodes in mismatch_index.values():
+            for node in nodes:
+                neighbors[node].extend(other for other in nodes if other != node)
+        return neighbors
+
+    def collapse(self):
+        """
+        Merge barcodes with one mismatch, with the result of `iterate_over_dict_indexed`
+        on the decoded counts: from the most frequent barcode (first seen first among
+        equal counts), every barcode absorbs the counts of the barcodes one mismatch
+        away that were not merged yet. Only the remaining barcodes are decoded.
+        :return: dictionary of barcodes and merged counts, from the most frequent
+        """
+        codes = np.flatnonzero(self.counts)
+        side = list(self.side_counts)
+        n_codes = len(codes)
+        node_counts = np.concatenate([self.counts[codes],
+                                      np.array([self.side_counts[b][0] for b in side], dtype=np.int64)])
+        node_first = np.concatenate([self.first_seen[codes],
+                                     np.array([self.side_counts[b][1] for b in side], dtype=np.int64)])
+        node_of_code = np.full(self.counts.size, -1, dtype=np.int64)
+        node_of_code[codes] = np.arange(n_codes)
+        offsets, targets = self._code_neighbors(codes, node_of_code)
+        side_neighbors = self._side_neighbors(side, node_of_code, n_codes)
+
+        node_counts_list = node_counts.tolist()
+        processed = bytearray(len(node_counts_list))
+        merged = []
+        for node in np.lexsort((node_first, -node_counts)).tolist():
+            if processed[node]:
+                continue
+            processed[node] = 1
+            total = node_counts_list[node]
+            neighbors = targets[offsets[node]:offsets[node + 1]] if node < n_codes else []
+            for neighbor in neighbors + side_neighbors.get(node, []):
+                if not processed[neighbor]:
+                    processed[neighbor] = 1
+                    total += node_counts_list[neighbor]
+            merged.append((node, total))
+
+        merged_codes = np.array([node for node, _ in merged if node < n_codes], dtype=np.int64)
+        decoded = iter(decode_barcodes(codes[merged_codes].astype(code_dtype(self.barcode_length)),
+                                       self.barcode_length)
+                       if len(merged_codes) else [])
+        collapsed = defaultdict(int)
+        for node, total in merged:
+            collapsed[next(decoded) if node < n_codes else side[node - n_codes]] = total
+        return collapsed
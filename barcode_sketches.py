@@ -0,0 +1,234 @@
+import sys
+import math
+import heapq
+import hashlib
+from collections import Counter
+import numpy as np
+
+
+def hash_barcodes(barcodes):
+    """
+    Deterministic 64-bit hashes of barcodes (unlike `hash`, the same in every process and run)
+    :param barcodes: list of barcode strings
+    :return: uint64 array of hashes
+    """
+    return np.fromiter((int.from_bytes(hashlib.blake2b(_barcode.encode('ascii'), digest_size=8).digest(), 'little')
+                        for _barcode in barcodes), dtype=np.uint64, count=len(barcodes))
+
+
+class CountMinSketch(object):
+    """
+    Count-min sketch: estimates never undercount, and overcount by at most
+    e / width * (total count) with probability 1 - exp(-depth)
+    """
+
+    def __init__(self, width=2 ** 20, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+
+    def _columns(self, hashes):
+        # Row i uses the hash h1 + i * h2 (Kirsch-Mitzenmacher), from the two halves of the 64-bit hash
+        low, high = hashes & np.uint64(0xFFFFFFFF), hashes >> np.uint64(32)
+        return [((low + np.uint64(i) * high) % np.uint64(self.width)).astype(np.int64) for i in range(self.depth)]
+
+    def add(self, hashes, weights):
+        """
+        :param hashes: uint64 array of item hashes
+        :param weights: int64 array of the counts to add to the items
+        """
+        for row, columns in zip(self.table, self._columns(hashes)):
+            np.add.at(row, columns, weights)
+        self.total += int(np.sum(weights))
+
+    def estimate(self, hashes):
+        """
+        :param hashes: uint64 array of item hashes
+        :return: int64 array of estimated counts
+        """
+        return np.min([row[columns] for row, columns in zip(self.table, self._columns(hashes))], axis=0)
+
+    @property
+    def error_bound(self):
+        """
+        :return: maximum overcount with probability `confidence`
+        """
+        return math.e / self.width * self.total
+
+    @property
+    def confidence(self):
+        return 1 - math.exp(-self.depth)
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+
+class HyperLogLog(object):
+    """HyperLogLog estimate of the number of distinct items, relative standard error 1.04 / sqrt(2^precision)"""
+
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError("HyperLogLog precision must be between 4 and 18.")
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    def add(self, hashes):
+        """
+        :param hashes: uint64 array of item hashes
+        """
+        remaining_bits = 64 - self.precision
+        indices = (hashes >> np.uint64(remaining_bits)).astype(np.int64)
+        remainder = hashes & np.uint64((1 << remaining_bits) - 1)
+        # Bit length of the remainder, from the float exponent corrected for rounding up
+        bit_length = np.frexp(remainder.astype(np.float64))[1].astype(np.int64)
+        rounded_up = (bit_length > 0) & \
+            ((np.uint64(1) << np.maximum(bit_length - 1, 0).astype(np.uint64)) > remainder)
+        bit_length -= rounded_up
+        # Position of the first 1 bit after the index bits
+        ranks = (remaining_bits - bit_length + 1).astype(np.uint8)
+        np.maximum.at(self.registers, indices, ranks)
+
+    def estimate(self):
+        """
+        :return: estimated number of distinct items
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw_estimate = alpha * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+        empty_registers = int(np.count_nonzero(self.registers == 0))
+        if raw_estimate <= 2.5 * m and empty_registers > 0:
+            # Linear counting is more accurate for small cardinalities
+            return m * math.log(m / empty_registers)
+        return raw_estimate
+
+    @property
+    def relative_error(self):
+        return 1.04 / math.sqrt(len(self.registers))
+
+    @property
+    def nbytes(self):
+        return self.registers.nbytes
+
+
+class SpaceSaving(object):
+    """
+    Space-Saving heavy hitters: keeps at most `capacity` items. The kept count of
+    an item overcounts it by at most its recorded error, and every item with a
+    true count above total / capacity is guaranteed to be kept.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        # Min-heap of (count, item), with stale entries skipped when popped
+        self._heap = []
+
+    def add(self, item, weight=1):
+        """
+        :param item: item to count
+        :param weight: count to add to the item
+        """
+        self.total += weight
+        if item in self.counts:
+            self.counts[item] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = weight
+            self.errors[item] = 0
+        else:
+            # Replace the item with the smallest count, inheriting its count as error
+            while True:
+                minimum, victim = heapq.heappop(self._heap)
+                if self.counts.get(victim) == minimum:
+                    break
+            del self.counts[victim], self.errors[victim]
+            self.counts[item] = minimum + weight
+            self.errors[item] = minimum
+        heapq.heappush(self._heap, (self.counts[item], item))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(_count, _item) for _item, _count in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def top(self):
+        """
+        :return: list of (item, count, error) sorted by decreasing count
+        """
+        return sorted(((_item, _count, self.errors[_item]) for _item, _count in self.counts.items()),
+                      key=lambda entry: (-entry[1], entry[0]))
+
+    @property
+    def guaranteed_threshold(self):
+        """
+        :return: items with a true count above this are always among the kept items
+        """
+        return self.total / self.capacity
+
+    @property
+    def nbytes(self):
+        """
+        :return: approximate memory of the kept items, their counts and errors, and the heap
+        """
+        if not self.counts:
+            return sys.getsizeof(self.counts) + sys.getsizeof(self.errors) + sys.getsizeof(self._heap)
+        # Size of one entry, from a kept item, times the number of entries
+        item, count = next(iter(self.counts.items()))
+        entry_bytes = sys.getsizeof(item) + sys.getsizeof(count) + sys.getsizeof(self.errors[item])
+        heap_entry_bytes = sys.getsizeof((count, item)) + 8
+        return (sys.getsizeof(self.counts) + sys.getsizeof(self.errors) + sys.getsizeof(self._heap) +
+                len(self.counts) * entry_bytes + len(self._heap) * heap_entry_bytes)
+
+
+class ApproximateBarcodeCounter(object):
+    """Fixed-memory barcode counting of one strand: count-min sketch, HyperLogLog and Space-Saving"""
+
+    def __init__(self, width=2 ** 20, depth=4, precision=14, top_k=10000):
+        self.count_min = CountMinSketch(width, depth)
+        self.distinct = HyperLogLog(precision)
+        self.heavy_hitters = SpaceSaving(top_k)
+
+    def add_batch(self, barcodes):
+        """
+        :param barcodes: list of barcode strings
+        """
+        if not barcodes:
+            return
+        batch_counts = Counter(barcodes)
+        unique_barcodes = list(batch_counts)
+        weights = np.fromiter(batch_counts.values(), dtype=np.int64, count=len(unique_barcodes))
+        hashes = hash_barcodes(unique_barcodes)
+        self.count_min.add(hashes, weights)
+        self.distinct.add(hashes)
+        for _barcode, _count in batch_counts.items():
+            self.heavy_hitters.add(_barcode, _count)
+
+    def barcode_counts(self):
+        """
+        Estimated counts of the kept heavy hitters: the smaller of the Space-Saving
+        and count-min estimates, both of which can only overcount
+        :return: dictionary of barcodes and estimated counts, by decreasing count
+        """
+        top = self.heavy_hitters.top()
+        if not top:
+            return {}
+        sketch_counts = self.count_min.estimate(hash_barcodes([_barcode for _barcode, _, _ in top]))
+        return {_barcode: min(_count, int(sketch_count))
+                for (_barcode, _count, _), sketch_count in zip(top, sketch_counts)}
+
+    def error_bounds(self):
+        """
+        :return: dictionary describing the accuracy of the estimates
+        """
+        return {
+            'total_reads': self.count_min.total,
+            'estimated_distinct_barcodes': self.distinct.estimate(),
+            'distinct_barcodes_relative_standard_error': self.distinct.relative_error,
+            'count_overestimate_bound': self.count_min.error_bound,
+            'count_overestimate_bound_confidence': self.count_min.confidence,
+            'heavy_hitters_kept': len(self.heavy_hitters.counts),
+            'heavy_hitters_guaranteed_above_count': self.heavy_hitters.guaranteed_threshold,
+            'heavy_hitters_max_overestimate': max(self.heavy_hitters.errors.values(), default=0),
+            'memory_bytes': self.count_min.nbytes + self.distinct.nbytes + self.heavy_hitters.nbytes
+        }
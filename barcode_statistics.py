@@ -0,0 +1,152 @@
+import os
+import numpy as np
+
+# Fixed histogram bins: [0, 1), [1, 2), [2, 4), [4, 8), ... so histograms of
+# separate batches or runs can be added together without knowing the range first
+HISTOGRAM_EDGES = np.concatenate([[0.0], 2.0 ** np.arange(0, 41)])
+
+
+class RunningMoments(object):
+    """Mean and variance updated one batch at a time (Welford / Chan et al.)"""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        """
+        :param values: array of new values
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        batch_mean = values.mean()
+        self.merge_moments(len(values), batch_mean, float(np.sum((values - batch_mean) ** 2)))
+
+    def merge_moments(self, n, mean, m2):
+        """
+        Combine with the moments of another set of values
+        :param n: number of values
+        :param mean: mean of the values
+        :param m2: sum of squared differences from their mean
+        """
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+    @property
+    def variance(self):
+        # Population variance, as np.var
+        return self.m2 / self.n if self.n else float('nan')
+
+    @property
+    def std(self):
+        return self.variance ** 0.5
+
+
+class BarcodeCountStatistics(object):
+    """
+    Single-pass statistics of the summary table rows: per-strand barcode numbers and
+    read totals, moments of the total reads per barcode, fixed-bin histograms of the
+    counts, and a uniform sample of rows for the bar plot (sample_size=0 skips it)
+    """
+
+    def __init__(self, sample_size=10, seed=None):
+        self.forward_barcodes = 0
+        self.reverse_barcodes = 0
+        self.forward_total = 0
+        self.reverse_total = 0
+        self.total_reads = RunningMoments()
+        self.forward_histogram = np.zeros(len(HISTOGRAM_EDGES) - 1, dtype=np.int64)
+        self.reverse_histogram = np.zeros(len(HISTOGRAM_EDGES) - 1, dtype=np.int64)
+        self.sample_size = sample_size
+        self.sample = []
+        self._sample_keys = np.empty(0)
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, forward_barcodes, forward_counts, reverse_counts):
+        """
+        Add a batch of summary rows
+        :param forward_barcodes: array of forward barcodes (None/NaN where absent)
+        :param forward_counts: float array of forward counts (NaN where absent)
+        :param reverse_counts: float array of reverse counts (NaN where absent)
+        """
+        forward_counts = np.asarray(forward_counts, dtype=np.float64)
+        reverse_counts = np.asarray(reverse_counts, dtype=np.float64)
+        has_forward, has_reverse = ~np.isnan(forward_counts), ~np.isnan(reverse_counts)
+        self.forward_barcodes += int(has_forward.sum())
+        self.reverse_barcodes += int(has_reverse.sum())
+        self.forward_total += int(forward_counts[has_forward].sum())
+        self.reverse_total += int(reverse_counts[has_reverse].sum())
+        self.total_reads.update(np.where(has_forward, forward_counts, 0) + np.where(has_reverse, reverse_counts, 0))
+        self.forward_histogram += np.histogram(forward_counts[has_forward], bins=HISTOGRAM_EDGES)[0]
+        self.reverse_histogram += np.histogram(reverse_counts[has_reverse], bins=HISTOGRAM_EDGES)[0]
+        if self.sample_size:
+            self._update_sample(forward_barcodes, forward_counts, reverse_counts, np.flatnonzero(has_forward))
+
+    def _update_sample(self, forward_barcodes, forward_counts, reverse_counts, rows):
+        # Every row with a forward barcode gets a uniform random key and the rows with the
+        # sample_size smallest keys so far are kept: a uniform sample without replacement
+        # of all the rows seen, updated a whole batch at a time
+        keys = self._rng.random(len(rows))
+        if len(rows) > self.sample_size:
+            smallest = np.argpartition(keys, self.sample_size)[:self.sample_size]
+            rows, keys = rows[smallest], keys[smallest]
+        candidates = self.sample + [(forward_barcodes[i], forward_counts[i], reverse_counts[i]) for i in rows]
+        keys = np.concatenate([self._sample_keys, keys])
+        kept = np.argsort(keys, kind='stable')[:self.sample_size]
+        self.sample = [candidates[i] for i in kept]
+        self._sample_keys = keys[kept]
+
+    def report(self):
+        """
+        :return: mean, standard deviation and variance of the total reads per barcode
+        """
+        print(f"Total number of forward barcodes: {self.forward_barcodes}\n"
+              f"Total count of forward barcodes: {self.forward_total}\n")
+        print(f"Total number of reverse barcodes: {self.reverse_barcodes}\n"
+              f"Total count of reverse barcodes: {self.reverse_total}\n\n")
+        print(f"Mean: {self.total_reads.mean}\nStandard Deviation: {self.total_reads.std}")
+        print(f"Variance: {self.total_reads.variance}")
+        return self.total_reads.mean, self.total_reads.std, self.total_reads.variance
+
+
+def plot_count_statistics(statistics, output_path):
+    """
+    Plot the precomputed histograms and the sampled barcodes. Matplotlib is
+    only imported here, with a non-interactive backend.
+    :param statistics: BarcodeCountStatistics
+    :param output_path: output path to store plots generated
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    # Plot a histogram showing distribution of the counts in both strands
+    plt.figure(figsize=(10, 6))
+    plt.stairs(statistics.forward_histogram, HISTOGRAM_EDGES, fill=True, color='blue', alpha=0.5,
+               label='Forward counts')
+    plt.stairs(statistics.reverse_histogram, HISTOGRAM_EDGES, fill=True, color='green', alpha=0.5,
+               label='Reverse counts')
+    # Only show the bins holding counts
+    used_bins = np.flatnonzero(statistics.forward_histogram + statistics.reverse_histogram)
+    if len(used_bins):
+        plt.xlim(max(HISTOGRAM_EDGES[used_bins[0]], 1), HISTOGRAM_EDGES[used_bins[-1] + 1])
+    plt.xscale('log', base=2)
+    plt.legend()
+    plt.savefig(os.path.join(output_path, 'histograms_of_barcode_distributions.png'))
+    plt.close()
+    # Plot a bar plot showing counts per barcode, for the randomly sampled barcodes
+    if statistics.sample:
+        barcodes, forward_counts, reverse_counts = zip(*statistics.sample)
+        positions = np.arange(len(barcodes))
+        plt.figure(figsize=(8, 5))
+        plt.bar(positions - 0.2, forward_counts, width=0.4, label='forward_count')
+        plt.bar(positions + 0.2, np.nan_to_num(reverse_counts), width=0.4, label='reverse_count')
+        plt.xticks(positions, barcodes, rotation=45)
+        plt.legend()
+        plt.subplots_adjust(bottom=0.15)
+        plt.savefig(os.path.join(output_path, 'barplot_difference_in_counts.png'))
+        plt.close()
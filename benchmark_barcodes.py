@@ -0,0 +1,152 @@
+import os
+import io
+import sys
+import json
+import gzip
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import pyfastx
+import analyze_barcodes as ab
+
+
+def generate_fastq(fq_file, n_reads, n_barcodes=1000, error_rate=0.01, reverse_fraction=0.5,
+                   tags=('CAT', 'GTA'), barcode_length=8, read_length=50, seed=0):
+    """
+    Write a synthetic FastQ file with Illumina-style `name:lane:x:y#index` headers
+    :param fq_file: output path, gzip compressed if it ends with `.gz`
+    :param n_reads: number of reads
+    :param n_barcodes: number of distinct true barcodes
+    :param error_rate: probability of a substitution at each barcode base
+    :param reverse_fraction: fraction of reads from the reverse strand
+    :param tags: forward and reverse strand identifiers
+    :param barcode_length: number of bases in a barcode
+    :param read_length: total length of each read
+    :param seed: seed of the random number generator
+    :return: path of the written file
+    """
+    rng = random.Random(seed)
+    true_barcodes = [''.join(rng.choice('ACGT') for _ in range(barcode_length)) for _ in range(n_barcodes)]
+    # Skewed barcode abundances, as in real libraries
+    weights = [1.0 / (rank + 1) for rank in range(n_barcodes)]
+    insert_length = max(read_length - len(tags[0]) - barcode_length, 0)
+    open_file = gzip.open if fq_file.endswith('.gz') else open
+    with open_file(fq_file, 'wt') as f:
+        for i, _barcode in enumerate(rng.choices(true_barcodes, weights=weights, k=n_reads)):
+            _barcode = ''.join(rng.choice('ACGT'.replace(base, '')) if rng.random() < error_rate else base
+                               for base in _barcode)
+            if rng.random() < reverse_fraction:
+                seq = tags[1] + ab.reverse_complement(_barcode)
+            else:
+                seq = tags[0] + _barcode
+            seq += ''.join(rng.choices('ACGT', k=insert_length))
+            name = f"SIM:{1 + i % 8}:{rng.randint(0, 30000)}:{rng.randint(0, 30000)}#0/1"
+            f.write(f"@{name}\n{seq}\n+\n{'I' * len(seq)}\n")
+    return fq_file
+
+
+def _measure(stage, n_reads, trace_memory):
+    """
+    Time a stage, and measure its peak traced memory if requested
+    :param stage: function without arguments running the stage
+    :param n_reads: number of reads processed by the stage
+    :param trace_memory: also run the stage under tracemalloc to get its peak memory
+    :return: result of the stage and dictionary of measurements
+    """
+    start = time.perf_counter()
+    result = stage()
+    seconds = time.perf_counter() - start
+    metrics = {'seconds': seconds, 'reads_per_second': n_reads / seconds if seconds > 0 else None}
+    if trace_memory:
+        # Separate run, since tracing slows the stage down
+        tracemalloc.start()
+        stage()
+        metrics['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, metrics
+
+
+def benchmark_fastq(fq_file, n_reads, tags=('CAT', 'GTA'), collapse_method='index', trace_memory=True):
+    """
+    Time each stage of the barcode pipeline on one FastQ file
+    :param fq_file: input FastQ file
+    :param n_reads: number of reads in the file
+    :param tags: forward and reverse strand identifiers
+    :param collapse_method: key of COLLAPSE_METHODS used to merge barcodes with one mismatch
+    :param trace_memory: also measure the peak memory of each stage
+    :return: dictionary of measurements per stage
+    """
+    stages = {}
+    (fow, rev, _, _), stages['create_barcode_frequency_dict'] = _measure(
+        lambda: ab.create_barcode_frequency_dict(pyfastx.Fastx(fq_file, comment=True), tags[0], tags[1],
+                                                 collapse_method=collapse_method),
+        n_reads, trace_memory)
+    raw_fow, raw_rev, _, _ = ab.count_barcode_reads(pyfastx.Fastx(fq_file, comment=True), tags[0], tags[1])
+    collapse_barcodes = ab.COLLAPSE_METHODS[collapse_method]
+    _, stages['iterate_over_dict'] = _measure(
+        lambda: (collapse_barcodes(raw_fow), collapse_barcodes(raw_rev)), n_reads, trace_memory)
+    stages['iterate_over_dict']['unique_barcodes'] = len(raw_fow) + len(raw_rev)
+    output_data, stages['summarize_barcodes'] = _measure(
+        lambda: ab.summarize_barcodes(fow, rev), n_reads, trace_memory)
+    with tempfile.TemporaryDirectory() as plot_path, contextlib.redirect_stdout(io.StringIO()):
+        _, stages['additional_count_statistics'] = _measure(
+            lambda: ab.additional_count_statistics(output_data, plot_path), n_reads, trace_memory)
+    return stages
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        prog='barcode_benchmark',
+        description='Benchmark each stage of the barcode analysis on seeded synthetic fastQ files')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000],
+                        help='Numbers of reads to benchmark default: 10000 100000')
+    parser.add_argument('--barcodes', type=int, default=1000, help='Number of distinct true barcodes default: 1000')
+    parser.add_argument('--error_rate', type=float, default=0.01,
+                        help='Probability of a substitution at each barcode base default: 0.01')
+    parser.add_argument('--reverse_fraction', type=float, default=0.5,
+                        help='Fraction of reads from the reverse strand default: 0.5')
+    parser.add_argument('-t', '--tags', nargs=2, default=['CAT', 'GTA'],
+                        help='Tags specifying the forward and reverse strands (in that order) default: CAT, GTA')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data default: 0')
+    parser.add_argument('--gzip', help='Write gzip compressed synthetic files', action='store_true')
+    parser.add_argument('--collapse_method', choices=sorted(ab.COLLAPSE_METHODS), default='index',
+                        help='Method used to merge barcodes with one mismatch default: index')
+    parser.add_argument('--no_memory', help='Do not measure peak memory (halves the run time)',
+                        action='store_true')
+    parser.add_argument('--work_dir', help='Directory for the synthetic files default: temporary directory')
+    parser.add_argument('-o', '--output_file', help='JSON report file default: print to stdout')
+
+    args = parser.parse_args()
+    report = {
+        'config': {k: v for k, v in vars(args).items() if k not in ('work_dir', 'output_file')},
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': []
+    }
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        work_dir = args.work_dir or temporary_dir
+        for n_reads in args.sizes:
+            fq_file = os.path.join(work_dir, f"synthetic_{n_reads}_{args.seed}.{'gz' if args.gzip else 'fq'}")
+            generate_fastq(fq_file, n_reads, n_barcodes=args.barcodes, error_rate=args.error_rate,
+                           reverse_fraction=args.reverse_fraction, tags=args.tags, seed=args.seed)
+            print(f"Benchmarking {n_reads} reads...", file=sys.stderr)
+            report['results'].append({
+                'n_reads': n_reads,
+                'file_size_bytes': os.path.getsize(fq_file),
+                'stages': benchmark_fastq(fq_file, n_reads, args.tags, args.collapse_method,
+                                          trace_memory=not args.no_memory)
+            })
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,187 @@
+import os
+import re
+import time
+import uuid
+import threading
+import contextlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 import psycopg2
+import psycopg2.pool
 from sshtunnel import SSHTunnelForwarder
+from query_cache import QueryCache
+
+# Errors after which a connection (or its tunnel) is considered broken
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# A query of a batch run by DBConnectionPool.run_queries; srv None routes read-only
+# queries to the read replica and other statements to the primary. read_only None
+# detects read-only queries with is_read_only, True or False overrides it.
+BatchQuery = namedtuple('BatchQuery', ['query', 'params', 'srv', 'read_only'])
+BatchQuery.__new__.__defaults__ = (None, None, None)
+READ_ONLY_STATEMENTS = ('select', 'with', 'show', 'explain', 'values', 'table')
+# String literals, quoted identifiers and comments, which are ignored when looking for writes
+_SQL_QUOTED = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/", re.DOTALL)
+# Data-modifying statements (e.g. in a WITH query), SELECT ... INTO, and row locks
+# (FOR UPDATE, FOR NO KEY UPDATE, FOR SHARE, FOR KEY SHARE), which must run on the primary
+_SQL_WRITES = re.compile(r"\b(?:insert|update|delete|merge|truncate|into|for\s+(?:key\s+)?share)\b", re.IGNORECASE)
+
+
+def is_read_only(query):
+    """
+    Conservative check that a query only reads: it starts with a read-only statement and
+    has no data-modifying part (e.g. a WITH query with a DELETE) nor row locks. Queries
+    mentioning these keywords elsewhere are treated as writes.
+    :param query: SQL query
+    :return: whether the query can run on a read replica
+    """
+    query = _SQL_QUOTED.sub(' ', query)
+    words = query.lstrip(' \t\n(').split(None, 1)
+    return bool(words) and words[0].lower() in READ_ONLY_STATEMENTS and not _SQL_WRITES.search(query)
+
+
+@contextlib.contextmanager
+def _read_transaction(connection):
+    # Named cursors and COPY run in a transaction, which is ended afterwards
+    # unless the caller already had one open
+    was_idle = connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    try:
+        yield
+    finally:
+        if was_idle and not connection.closed:
+            connection.rollback()
+
+
+def fetch_dataframe(connection, query, params=None):
+    """
+    :param connection: DB-API connection (psycopg2, or e.g. a local stand-in database)
+    :return: results of the query as a pandas DataFrame
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query, params)
+        return pd.DataFrame(cursor.fetchall(), columns=[column[0] for column in cursor.description])
+    finally:
+        cursor.close()
+
+
+def stream_query(connection, query, params=None, itersize=10000, as_dataframe=False):
+    """
+    Run a query on a server-side (named) cursor and yield the results in batches,
+    so only `itersize` rows at a time are sent through the tunnel and held in memory
+    :param connection: psycopg2 connection
+    :param query: SQL query
+    :param params: query parameters
+    :param itersize: number of rows per batch
+    :param as_dataframe: yield pandas DataFrames instead of lists of row tuples
+    """
+    with _read_transaction(connection):
+        with connection.cursor(name="stream_{}".format(uuid.uuid4().hex)) as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(itersize)
+                if not rows:
+                    break
+                if as_dataframe:
+                    yield pd.DataFrame(rows, columns=[column[0] for column in cursor.description])
+                else:
+                    yield rows
+
+
+def export_query(connection, query, output_file, output_format='csv', params=None):
+    """
+    Export the results of a query with COPY ... TO STDOUT, streamed straight to disk
+    without building Python rows
+    :param connection: psycopg2 connection
+    :param query: SQL query
+    :param output_file: output path
+    :param output_format: 'csv' (with a header line) or 'parquet'
+    :param params: query parameters
+    """
+    with _read_transaction(connection):
+        with connection.cursor() as cursor:
+            if params is not None:
+                # COPY does not take parameters, so they are bound client-side
+                query = cursor.mogrify(query, params).decode(psycopg2.extensions.encodings[connection.encoding])
+            copy_sql = "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)".format(query.strip().rstrip(';'))
+            if output_format == 'csv':
+                with open(output_file, 'wb') as f:
+                    cursor.copy_expert(copy_sql, f)
+            elif output_format == 'parquet':
+                _copy_to_parquet(cursor, query, copy_sql, output_file)
+            else:
+                raise NotImplementedError("Export format not supported")
+    return output_file
+
+
+# PostgreSQL type OIDs of the result columns and the Arrow types their COPY CSV text is
+# parsed as; columns of other types (text, varchar, json, uuid, arrays...) are kept as strings
+_ARROW_TYPE_NAMES = {16: 'bool_', 20: 'int64', 21: 'int16', 23: 'int32', 26: 'int64', 700: 'float32',
+                     701: 'float64', 1700: 'float64', 1082: 'date32'}
+
+
+def _arrow_column_types(cursor, query):
+    """
+    Arrow types of the result columns of a query, from its column types in PostgreSQL,
+    so that the types do not depend on the values of the first rows (e.g. all NULL)
+    :param cursor: psycopg2 cursor
+    :param query: SQL query, with its parameters bound
+    :return: dictionary of the column names and their Arrow types
+    """
+    import pyarrow
+    cursor.execute("SELECT * FROM ({}) AS export_query LIMIT 0".format(query.strip().rstrip(';')))
+    column_types = {}
+    for column in cursor.description:
+        if column.type_code == 1114:
+            column_types[column.name] = pyarrow.timestamp('us')
+        elif column.type_code == 1184:
+            column_types[column.name] = pyarrow.timestamp('us', tz='UTC')
+        else:
+            column_types[column.name] = getattr(pyarrow, _ARROW_TYPE_NAMES.get(column.type_code, 'string'))()
+    return column_types
+
+
+def _copy_to_parquet(cursor, query, copy_sql, output_file):
+    # COPY writes CSV into a pipe from a thread while pyarrow parses it in blocks
+    # and appends them to the Parquet file
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.parquet
+    # COPY writes NULL as an empty field and an empty string as "", which are kept apart
+    convert_options = pyarrow.csv.ConvertOptions(column_types=_arrow_column_types(cursor, query),
+                                                 strings_can_be_null=True, quoted_strings_can_be_null=False,
+                                                 true_values=['t'], false_values=['f'])
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def copy():
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe:
+                cursor.copy_expert(copy_sql, pipe)
+        except Exception as error:
+            errors.append(error)
+
+    copy_thread = threading.Thread(target=copy, daemon=True)
+    copy_thread.start()
+    try:
+        with os.fdopen(read_fd, 'rb') as pipe:
+            reader = pyarrow.csv.open_csv(pipe, convert_options=convert_options)
+            with pyarrow.parquet.ParquetWriter(output_file, reader.schema, compression='zstd') as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+    except pyarrow.ArrowException as error:
+        # A failed COPY shows up as a truncated or empty CSV: raise the COPY error instead.
+        # A broken pipe only means the reader stopped first.
+        copy_thread.join()
+        if errors and not isinstance(errors[0], BrokenPipeError):
+            raise errors[0] from error
+        raise
+    finally:
+        copy_thread.join()
+    if errors:
+        raise errors[0]
 
 
 class DBConnect(object):
@@ -10,16 +192,20 @@ class DBConnect(object):
     localport = 5432
     servers = None
     tunnels = None
+    # Opt-in QueryCache of `cached_query` results, see `enable_query_cache`
+    query_cache = None
 
-    def __new__(cls, srv):
+    def __new__(cls, srv, dsn=None):
         if cls._instance is None:
             cls._instance = object.__new__(cls)
             print("Have srv {}".format(srv))
             # Can add use of a config file elsewhere
         return cls._instance
 
-    def __init__(self, srv):
-        self.servers = {
+    @classmethod
+    def connection_config(cls):
+        """Database (host, name, user, password) and SSH tunnel settings of every server"""
+        servers = {
             'mds': ['mds-production-db.cdk1nb86kzjj.us-east-1.rds.amazonaws.com',
                     'mds', 'read_only_user', '5gpedpU7UufvzRr2sz3m4x'],
             'mds-read-replica': ['mds-production-db-slave.cdk1nb86kzjj.us-east-1.rds.amazonaws.com',
@@ -28,17 +214,29 @@ class DBConnect(object):
                                'mds', 'read_only_user', '5gpedpU7UufvzRr2sz3m4x']
         }
         # host: URL, user, [defined elsewhere]
-        self.tunnels = {
+        tunnels = {
             'mds': ['bastion.mds.genalyte.com',
-                    'ubuntu', self.keymds, self.port, self.localport],
+                    'ubuntu', cls.keymds, cls.port, cls.localport],
             'mds-read-replica': ['bastion.mds.genalyte.com',
-                    'ubuntu', self.keymds, self.port, self.localport],
+                    'ubuntu', cls.keymds, cls.port, cls.localport],
             'mds-validation': ['bastion.mds.genalyte.com',
-                    'ubuntu', self.keymds, self.port, self.localport]
+                    'ubuntu', cls.keymds, cls.port, cls.localport]
         }
+        return servers, tunnels
 
-        self.open_tunnel(srv)
-        self.open_db(srv)
+    def __init__(self, srv, dsn=None):
+        """
+        :param srv: server name, e.g. 'mds'
+        :param dsn: libpq connection string (e.g. 'host=localhost dbname=mds') to connect
+            to directly, without an SSH tunnel, e.g. to a local PostgreSQL server
+        """
+        self.servers, self.tunnels = DBConnect.connection_config()
+        self.srv = srv
+        if dsn is None:
+            self.open_tunnel(srv)
+            self.open_db(srv)
+        else:
+            self.open_db_direct(dsn)
         self.tunnel = self._instance.tunnel
         self.connection = self._instance.connection
         self.cursor = self._instance.cursor
@@ -107,6 +305,21 @@ class DBConnect(object):
         print(" established. \n-v {}".format(db_version[0]))
         return DBConnect._instance
 
+    def open_db_direct(self, dsn):
+        # Connecting without ssh tunnel
+        DBConnect._instance.tunnel = None
+        try:
+            connection = DBConnect._instance.connection = psycopg2.connect(dsn)
+            cursor = DBConnect._instance.cursor = connection.cursor()
+            cursor.execute('SELECT VERSION()')
+            db_version = cursor.fetchone()
+        except Exception as error:
+            print('Error: DB connection not established.\n{}'.format(error))
+            DBConnect._instance = None
+            exit(-1)
+        print(" established. \n-v {}".format(db_version[0]))
+        return DBConnect._instance
+
     def get_cursor(self):
         return self.connection.cursor()
 
@@ -119,7 +332,286 @@ class DBConnect(object):
         else:
             return result
 
+    def enable_query_cache(self, cache_dir, max_bytes=2 ** 30, default_ttl=3600):
+        """
+        Cache the results of `cached_query` on local disk
+        :param cache_dir: directory of the cached results
+        :param max_bytes: size of the cache above which the least recently used results are evicted
+        :param default_ttl: seconds a result stays valid when the query sets no ttl
+        """
+        self.query_cache = QueryCache(cache_dir, max_bytes, default_ttl)
+        return self.query_cache
+
+    def cached_query(self, query, params=None, ttl=None):
+        """
+        Results of a read-only query as a DataFrame, reused from the query cache when
+        enabled and not older than `ttl` seconds
+        """
+        if self.query_cache is None:
+            return fetch_dataframe(self.connection, query, params)
+        return self.query_cache.get_or_fetch(self.srv, query, lambda: fetch_dataframe(self.connection, query, params),
+                                             params, ttl)
+
+    def stream_query(self, query, params=None, itersize=10000, as_dataframe=False):
+        """Yield the results of a query in batches of `itersize` rows, see `stream_query`"""
+        return stream_query(self.connection, query, params, itersize, as_dataframe)
+
+    def export_query(self, query, output_file, output_format='csv', params=None):
+        """Export the results of a query to CSV or Parquet with COPY, see `export_query`"""
+        return export_query(self.connection, query, output_file, output_format, params)
+
     # def __del__(self):
     #     self.connection.close()
     #     self.tunnel.close()
 
+
+class DBConnectionPool(object):
+    """
+    Connections to several servers at once, usable from several threads: one SSH tunnel
+    per server (each on its own free local port) and a bounded pool of connections per
+    server, checked out with `connection` or `cursor`. Connections idle for longer than
+    `health_check_interval` seconds are checked before use, and broken connections or
+    tunnels are reopened. Servers given in `dsns` are connected to directly, without
+    an SSH tunnel (e.g. {'mds': 'host=localhost dbname=mds'} for a local PostgreSQL).
+    """
+
+    def __init__(self, max_connections=4, min_connections=1, health_check_interval=60, retries=2,
+                 query_cache=None, dsns=None):
+        self.servers, self.tunnels = DBConnect.connection_config()
+        # libpq connection strings of the servers reached without a tunnel
+        self.dsns = dict(dsns or {})
+        for srv in self.dsns:
+            self.servers.setdefault(srv, None)
+        # Optional QueryCache of `cached_query` results
+        self.query_cache = query_cache
+        self.max_connections = max_connections
+        self.min_connections = min_connections
+        self.health_check_interval = health_check_interval
+        self.retries = retries
+        self._tunnels = {}
+        self._pools = {}
+        self._slots = {}
+        self._last_used = {}
+        self._locks = {srv: threading.Lock() for srv in self.servers}
+
+    def _open(self, srv):
+        # Open (or reopen) the tunnel and the connection pool of a server
+        if srv in self.dsns:
+            self._close(srv)
+            self._pools[srv] = psycopg2.pool.ThreadedConnectionPool(self.min_connections, self.max_connections,
+                                                                    self.dsns[srv])
+            return
+        SSH_HOST, SSH_USER, SSH_KEYFILE, DB_PORT, _ = self.tunnels[srv]
+        DB_HOST, DB_NAME, DB_USER, DB_PWRD = self.servers[srv]
+        self._close(srv)
+        tunnel = SSHTunnelForwarder(
+            (SSH_HOST, 22),
+            ssh_pkey=SSH_KEYFILE,
+            ssh_username=SSH_USER,
+            remote_bind_address=(DB_HOST, DB_PORT),
+            # Port 0: a free local port, so tunnels to several servers can be open together
+            local_bind_address=('localhost', 0)
+        )
+        tunnel.start()
+        print("SSH tunnel to {} on local port {}".format(srv, tunnel.local_bind_port))
+        self._tunnels[srv] = tunnel
+        self._pools[srv] = psycopg2.pool.ThreadedConnectionPool(
+            self.min_connections, self.max_connections,
+            dbname=DB_NAME,
+            user=DB_USER,
+            host=tunnel.local_bind_host,
+            port=tunnel.local_bind_port,
+            password=DB_PWRD
+        )
+
+    def _close(self, srv):
+        pool = self._pools.pop(srv, None)
+        if pool is not None:
+            pool.closeall()
+        tunnel = self._tunnels.pop(srv, None)
+        if tunnel is not None:
+            tunnel.stop()
+
+    def _pool(self, srv):
+        with self._locks[srv]:
+            if srv not in self._pools or (srv in self._tunnels and not self._tunnels[srv].is_active):
+                self._open(srv)
+            return self._pools[srv]
+
+    def _reconnect(self, srv, pool):
+        # Reopen the server's tunnel and pool, unless another thread already did
+        with self._locks[srv]:
+            if self._pools.get(srv) is pool:
+                print("Reconnecting to {}".format(srv))
+                self._open(srv)
+
+    def _healthy(self, connection):
+        if connection.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(connection), 0) < self.health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def _checkout(self, srv):
+        # A stale connection is only discarded from the pool; the tunnel and pool are
+        # only reopened when the tunnel is down (see _pool) or when no new connection
+        # can be opened several times in a row, since reopening the pool closes the
+        # connections other threads are using
+        getconn_failures = 0
+        stale_connections = 0
+        while True:
+            pool = self._pool(srv)
+            try:
+                connection = pool.getconn()
+            except CONNECTION_ERRORS:
+                getconn_failures += 1
+                if getconn_failures > self.retries:
+                    raise psycopg2.OperationalError("Could not connect to {}".format(srv))
+                if getconn_failures > 1:
+                    self._reconnect(srv, pool)
+                continue
+            if self._healthy(connection):
+                return connection, pool
+            pool.putconn(connection, close=True)
+            stale_connections += 1
+            if stale_connections > self.max_connections + self.retries:
+                raise psycopg2.OperationalError("No healthy connection to {}".format(srv))
+
+    @contextlib.contextmanager
+    def connection(self, srv):
+        """
+        Check out a connection to a server, waiting while all of its connections are in use.
+        Uncommitted work is rolled back when the connection is returned.
+        :param srv: server name, e.g. 'mds' or 'mds-read-replica'
+        """
+        if srv not in self.servers:
+            raise KeyError("Unknown server {}".format(srv))
+        with self._locks[srv]:
+            slots = self._slots.setdefault(srv, threading.BoundedSemaphore(self.max_connections))
+        with slots:
+            connection, pool = self._checkout(srv)
+            broken = False
+            try:
+                yield connection
+            except CONNECTION_ERRORS:
+                broken = True
+                raise
+            finally:
+                broken = broken or connection.closed
+                if not broken:
+                    try:
+                        connection.rollback()
+                    except CONNECTION_ERRORS:
+                        broken = True
+                self._last_used[id(connection)] = time.monotonic()
+                try:
+                    pool.putconn(connection, close=broken)
+                except psycopg2.pool.PoolError:
+                    # The pool was reopened while the connection was checked out
+                    connection.close()
+
+    @contextlib.contextmanager
+    def cursor(self, srv):
+        with self.connection(srv) as connection:
+            with connection.cursor() as cursor:
+                yield cursor
+
+    def query(self, srv, query, params=None):
+        """
+        Run a query, retrying on a fresh connection if the connection breaks
+        :return: list of result rows, or None for statements without results
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with self.cursor(srv) as cursor:
+                    cursor.execute(query, params)
+                    return cursor.fetchall() if cursor.description is not None else None
+            except CONNECTION_ERRORS as error:
+                if attempt == self.retries:
+                    raise
+                print('Retrying query on {} after connection error [{}]'.format(srv, error))
+
+    def cached_query(self, srv, query, params=None, ttl=None):
+        """Results of a read-only query as a DataFrame, from the query cache if there is one"""
+        def fetch():
+            with self.connection(srv) as connection:
+                return fetch_dataframe(connection, query, params)
+        if self.query_cache is None:
+            return fetch()
+        return self.query_cache.get_or_fetch(srv, query, fetch, params, ttl)
+
+    def stream_query(self, srv, query, params=None, itersize=10000, as_dataframe=False):
+        """Yield the results of a query in batches, keeping one connection checked out meanwhile"""
+        with self.connection(srv) as connection:
+            for batch in stream_query(connection, query, params, itersize, as_dataframe):
+                yield batch
+
+    def export_query(self, srv, query, output_file, output_format='csv', params=None):
+        with self.connection(srv) as connection:
+            return export_query(connection, query, output_file, output_format, params)
+
+    def execute(self, srv, query, params=None):
+        """Run a statement that changes data and commit it"""
+        with self.connection(srv) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                row_count = cursor.rowcount
+            connection.commit()
+        return row_count
+
+    def run_queries(self, queries, primary='mds', read_replica='mds-read-replica', per_server_limit=None):
+        """
+        Run independent queries concurrently over the pooled connections
+        :param queries: list of queries, (query, params) tuples or BatchQuery, with read_only
+            set to route a query whose type is not detected correctly
+        :param primary: server of the statements that change data
+        :param read_replica: server of the read-only queries without a server
+        :param per_server_limit: maximum number of queries running at once on a server,
+            default: max_connections
+        :return: list of results in the order of the queries (DataFrames for read-only
+            queries, row counts otherwise), and list of the latency of every query
+        """
+        batch = [BatchQuery(query) if isinstance(query, str) else BatchQuery(*query) for query in queries]
+        batch = [query if query.read_only is not None else query._replace(read_only=is_read_only(query.query))
+                 for query in batch]
+        servers = [query.srv or (read_replica if query.read_only else primary) for query in batch]
+        limit = min(per_server_limit or self.max_connections, self.max_connections)
+        server_slots = {srv: threading.BoundedSemaphore(limit) for srv in set(servers)}
+
+        def run(query, srv):
+            with server_slots[srv]:
+                start = time.perf_counter()
+                if query.read_only:
+                    result = self.cached_query(srv, query.query, query.params)
+                    rows = len(result)
+                else:
+                    result = rows = self.execute(srv, query.query, query.params)
+                return result, {'srv': srv, 'seconds': time.perf_counter() - start, 'rows': rows}
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(limit * len(server_slots), 1)) as executor:
+            futures = [executor.submit(run, query, srv) for query, srv in zip(batch, servers)]
+            outcomes = [future.result() for future in futures]
+        results = [result for result, _ in outcomes]
+        latencies = [dict(latency, query=i) for i, (_, latency) in enumerate(outcomes)]
+        wall_seconds = time.perf_counter() - start
+        print('Ran {} queries in {:.2f}s, {:.2f}s one after another'.format(
+            len(batch), wall_seconds, sum(latency['seconds'] for latency in latencies)))
+        return results, latencies
+
+    def close(self):
+        for srv in list(self._pools):
+            with self._locks[srv]:
+                self._close(srv)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,27 +1,160 @@
 import os
+import functools
+from collections import namedtuple
 
+import numpy as np
 import pandas as pd
 
-import auxilliary_functions as fx
+from aggregation_cache import CsvCache
+from aggregation_loader import load_files, print_load_times
+from aggregation_output import write_csv_threaded, write_parquet
+from aggregation_schema import compact_frame, memory_report
+from aggregation_stages import StageGraph
+from pipeline_metrics import PipelineMetrics, instrumented_stage
 from glob import glob
 from main.backend.src.python_v6.auxilliary_functions import *
 
 
+# A frame to be joined on MEMBER_SK: `how` is "left" (keep all members, like my_join)
+# or "inner" (keep only members in both, like pd.merge), and `fill_value` replaces
+# the NAs of the joined columns (NA_columns in my_join)
+JoinSource = namedtuple("JoinSource", ["data", "how", "fill_value"])
+JoinSource.__new__.__defaults__ = ("left", None)
+
+CLAIMS_FILES = ["claimsUserYear.csv", "claimsUserQuarter.csv", "claimsCategoryYear.csv",
+                "claimsCategoryQuarter.csv", "claimsTermYear.csv", "claimsTermYearQuarter.csv",
+                "claimsModelConditions.csv"]
+
+
+def join_on_member_sk(data_to_model, sources):
+    # Join all the sources at once: each one is indexed on MEMBER_SK and aligned to the
+    # final set of members, then everything is put side by side with a single concat,
+    # instead of copying the widening frame once per merge
+    data_to_model = data_to_model.set_index("MEMBER_SK")
+    members = data_to_model.index
+    indexed_sources = []
+    for source in sources:
+        data = source.data.set_index("MEMBER_SK")
+        if not data.index.is_unique:
+            raise ValueError(f"BASEHEALTH: MEMBER_SK is not unique in the source with columns "
+                             f"{list(data.columns[:5])}")
+        if source.how == "inner":
+            members = members[members.isin(data.index)]
+        indexed_sources.append((data, source.fill_value))
+    aligned = [data_to_model if members is data_to_model.index else data_to_model.loc[members]]
+    for data, fill_value in indexed_sources:
+        data = data.reindex(members)
+        if fill_value is not None:
+            data = data.fillna(fill_value)
+        aligned.append(data)
+    return pd.concat(aligned, axis=1).reset_index()
+
+
+def eligibility_column_groups(columns, years):
+    # Columns adjusted for each claims year, found once instead of regex scans per step
+    quarterly = columns.str.contains("_Q[1-4]")
+    column_groups = {}
+    for year in years:
+        column_groups[year] = {
+            "claims": columns[columns.str.contains("^(?:Claims |Category *)" + str(year)) & ~quarterly],
+            "RAF": columns[columns.str.contains("^(?:RAF |RAF_nonDemog *)" + str(year)) & ~quarterly],
+            "status": columns[columns.str.contains("^Status0 " + str(year)) & ~quarterly],
+            "quarterly_claims": columns[columns.str.contains("^Claims " + str(year)) & quarterly]}
+    return column_groups
+
+
+def set_zero_to_na_rows(block, rows):
+    # auxilliary_functions.set_zero_to_na on the given rows of a float block, in place
+    block[rows[:, None] & (block == 0)] = np.nan
+
+
 class AggregateAllDataInit():
-    def __init__(self, prediction_year):
+    def __init__(self, prediction_year, cache_dir=None, compact_dtypes=False,
+                 client_data_path="", during_analysis_data_path="", raw_RFs_path="", metrics=None):
         # TODO: import paths
-        self.client_data_path = ""
-        self.during_analysis_data_path = ""
-        self.raw_RFs_path = ""
+        self.client_data_path = client_data_path
+        self.during_analysis_data_path = during_analysis_data_path
+        self.raw_RFs_path = raw_RFs_path
         self.prediction_year = prediction_year
+        # Parsed CSV inputs are cached in cache_dir between runs (e.g. for other prediction years)
+        self.csv_cache = CsvCache(cache_dir) if cache_dir is not None else None
+        # Frames read ahead by load_sources, taken by the first read of the same file
+        self.loaded_sources = {}
+        self.load_times = []
+        # Store the inputs and data_to_model with the compact dtypes of aggregation_schema
+        self.compact_dtypes = compact_dtypes
+        # Timing and memory of every step, written next to aggregatedData.csv; pass
+        # PipelineMetrics(profile=True, profile_stage=...) to profile one step
+        self.metrics = metrics if metrics is not None else PipelineMetrics()
         self.clinical_data_path = os.path.join(self.client_data_path, "clinical")
         self.claims_based_data_path = os.path.join(self.during_analysis_data_path,
                                                    "aggregatedData/claimsBasedDataPath")
         self.lab_based_data_path = os.path.join(self.during_analysis_data_path,
                                                 "aggregatedData/labBasedData")
-        self.RF_data = my_read_csv(self.raw_RFs_path)
+        self.RF_data = self._read_csv(self.raw_RFs_path, my_read_csv)
         self.aggregated_data_path = os.path.join(self.during_analysis_data_path, "aggregatedData")
 
+    def _read_csv(self, path, reader=pd.read_csv, **kwargs):
+        if not kwargs and (path, reader) in self.loaded_sources:
+            return self.loaded_sources.pop((path, reader))
+        if self.csv_cache is None:
+            data = reader(path, **kwargs)
+        else:
+            data = self.csv_cache.read(path, reader, **kwargs)
+        return self._compact(data)
+
+    def _compact(self, data):
+        # Joins and adjustments widen dtypes (e.g. NaN for missing members), so this is
+        # applied again after every step
+        return compact_frame(data) if self.compact_dtypes else data
+
+    def memory_report(self):
+        report = memory_report(self.data_to_model)
+        print(report)
+        return report
+
+    def _lab_files(self):
+        return [os.path.join(self.lab_based_data_path),
+                os.path.join(self.lab_based_data_path, "labLatestValuesYearly.csv")]
+
+    def _condition_status_files(self):
+        condition_status_years = glob(os.path.join(self.client_data_path, "yearWiseRFdata/extreme/rawRFs/") + '201.$')
+        return [(condition_status_year,
+                 os.path.join(self.client_data_path, "yearWiseRFdata/extreme/rawRFs", condition_status_year))
+                for condition_status_year in condition_status_years]
+
+    def _RAF_files(self):
+        return glob(os.path.join(self.client_data_path, "RAF") + "*.csv")
+
+    def _adjusted_OR_files(self):
+        file_dir = os.path.join(self.during_analysis_data_path, "augmentedORs/hierarchial/mergedHierarchialData/")
+        return glob(file_dir + "*.csv")
+
+    @instrumented_stage
+    def load_sources(self, include_RAF=True, include_adjusted_ORs=True, workers=4, memory_budget=8 * 2 ** 30):
+        # The lab, claims, condition status, RAF and adjusted OR files do not depend on each
+        # other: read them all concurrently ahead of the join steps, which then take them
+        # from self.loaded_sources instead of reading them one after another
+        loads = [(path, pd.read_csv) for path in self._lab_files()]
+        loads += [(os.path.join(self.claims_based_data_path, claims_file), pd.read_csv) for claims_file in CLAIMS_FILES]
+        loads.append((os.path.join(preDeterminedDataPath, "diseaseStatistics/diseasesData.csv"), pd.read_csv))
+        loads += [(path, my_read_csv) for _, path in self._condition_status_files()]
+        loads.append((os.path.join(self.claims_based_data_path, "diseaseStatusYear.csv"), pd.read_csv))
+        if include_RAF:
+            loads += [(path, pd.read_csv) for path in self._RAF_files()]
+        if include_adjusted_ORs:
+            loads += [(path, pd.read_csv) for path in self._adjusted_OR_files()]
+        # Missing inputs are left to fail where they are used
+        loads = [(path, reader) for path, reader in loads if os.path.exists(path)]
+        # Reads still go through the cache, if there is one
+        readers = {reader: functools.partial(self._read_csv, reader=reader) for _, reader in loads}
+        loaded, self.load_times = load_files([(path, readers[reader]) for path, reader in loads],
+                                             max_workers=workers, memory_budget=memory_budget)
+        for path, reader in loads:
+            self.loaded_sources[(path, reader)] = loaded[(path, readers[reader])]
+        print_load_times(self.load_times)
+        return self
+
     def _preprocess_data(self):
         demog_cols = {"MEMBER_SK": "MEMBER_SK", "Age": "Patient_Age", "Gender": "Gender",
                       "Ethnicity": "Ethnicity", "DOD": "MEM_DOD", "DOD IND": "DOD_IND"}
@@ -46,152 +179,212 @@ class AggregateAllDataInit():
         data_to_model = self.RF_data
         return data_to_model
 
+    @instrumented_stage
     def process_lab_data(self):
         data_to_model = AggregateAllDataInit._preprocess_data(self)
-        lab_extreme_values_yearly = pd.read_csv(os.path.join(self.lab_based_data_path))
+        lab_extreme_values_yearly_file, lab_latest_values_yearly_file = self._lab_files()
+        lab_extreme_values_yearly = self._read_csv(lab_extreme_values_yearly_file)
         data_to_model = pd.merge(data_to_model, lab_extreme_values_yearly)
 
-        lab_latest_values_yearly = pd.read_csv(os.path.join(self.lab_based_data_path,
-                                                            "labLatestValuesYearly.csv"))
+        lab_latest_values_yearly = self._read_csv(lab_latest_values_yearly_file)
         data_to_model = pd.merge(data_to_model, lab_latest_values_yearly)
-        self.data_to_model = data_to_model
+        self.data_to_model = self._compact(data_to_model)
         return self
 
+    @instrumented_stage
     def aggregate_claims(self, include_RAF=True):
-        claims_user_year = pd.read_csv(os.path.join(self.claims_based_data_path,"claimsUserYear.csv"))
-        self.data_to_model = my_join(self.data_to_model, claims_user_year, NA_columns=0)
+        # Every source is read first and joined once at the end
+        sources = []
+        for claims_file in CLAIMS_FILES:
+            claims_data = self._read_csv(os.path.join(self.claims_based_data_path, claims_file))
+            sources.append(JoinSource(claims_data, fill_value=0))
+        claims_user_year = sources[0].data
         self.claims_data_years = [re.sub(pattern="Claims ", repl="", string=i) for i in claims_user_year.columns]
-        claims_user_quarter = pd.read_csv(os.path.join(self.claims_based_data_path,"claimsUserQuarter.csv"))
-        self.data_to_model = my_join(self.data_to_model, claims_user_quarter, NA_columns=0)
-
-        claims_category_year = pd.read_csv(os.path.join(self.claims_based_data_path,"claimsCategoryYear.csv"))
-        self.data_to_model = my_join(self.data_to_model, claims_category_year, NA_columns=0)
-
-        claims_category_quarter = pd.read_csv(os.path.join(self.claims_based_data_path,"claimsCategoryQuarter.csv"))
-        self.data_to_model = my_join(self.data_to_model, claims_category_quarter, NA_columns=0)
-
-        claims_term_year = pd.read_csv(os.path.join(self.claims_based_data_path,"claimsTermYear.csv"))
-        self.data_to_model = my_join(self.data_to_model, claims_term_year, NA_columns=0)
-        claims_term_quarter = pd.read_csv(os.path.join(self.claims_based_data_path,"claimsTermYearQuarter.csv"))
-        self.data_to_model = my_join(self.data_to_model, claims_term_quarter, NA_columns=0)
-
-        claims_model_condition = pd.read_csv(os.path.join(self.claims_based_data_path, "claimsModelConditions.csv"))
-        self.data_to_model = my_join(self.data_to_model, claims_model_condition, NA_columns=0)
 
         print("Condition statuses...\n\n")
-        condition_status_years = glob(os.path.join(self.client_data_path, "yearWiseRFdata/extreme/rawRFs/") + '201.$')
-        disease_external_data = pd.read_csv(os.path.join(preDeterminedDataPath, "diseaseStatistics/diseasesData.csv"))
+        disease_external_data = self._read_csv(os.path.join(preDeterminedDataPath, "diseaseStatistics/diseasesData.csv"))
 
-        for condition_status_year in condition_status_years:
-            data_file_path = os.path.join(self.client_data_path,
-                                          "yearWiseRFdata/extreme/rawRFs",
-                                          condition_status_year)
-            condition_statuses = my_read_csv(data_file_path)
+        for condition_status_year, data_file_path in self._condition_status_files():
+            condition_statuses = self._read_csv(data_file_path, my_read_csv)
             condition_statuses = condition_statuses[["MEMBER_SK"] + disease_external_data['Disease Name']]
             col_matches = condition_statuses.columns.isin()
             condition_statuses.columns = disease_external_data['Disease Full Name']\
                 [np.where(condition_statuses.columns.isin(disease_external_data['Disease Name']))]
             condition_statuses.columns = ["Status " + str(condition_status_year) + "_" +
                                           i for i in condition_statuses.columns]
-            self.data_to_model = my_join(self.data_to_model, condition_statuses)
+            sources.append(JoinSource(condition_statuses))
 
-        disease_status_year = pd.read_csv(os.path.join(self.claims_based_data_path, "diseaseStatusYear.csv"))
+        disease_status_year = self._read_csv(os.path.join(self.claims_based_data_path, "diseaseStatusYear.csv"))
         disease_status_year = disease_status_year[~disease_status_year.columns.isin(["MEMBER_SK"])].apply(lambda x: 1 if True else 0)
         if include_RAF:
             print("RAF aggregate...\n\n")
-            file_dir = os.path.join(self.client_data_path, "RAF")
-            file_names = glob(file_dir + "*.csv")
-            for file_name in file_names:
+            for file_name in self._RAF_files():
                 filename = os.path.basename(file_name)
                 year = re.search(r'\d+', filename).group(0)
                 if year is None:
                     raise "BASEHEALTH: The format of RAF data files should be \"totalSumCommunity_[YEAR].csv\""
-                RAF_data = pd.read_csv(file_name)
+                RAF_data = self._read_csv(file_name)
                 RAF_data['RAF_nonDemog'] = RAF_data["totalSum"] - RAF_data["ageSexSum"]
                 RAF_data.columns = ["MEMBER_SK", "RAF_"+ str(year), "RAF_demog_"+str(year), "RAF_nonDemog_"+str(year)]
-                self.data_to_model = pd.merge(self.data_to_model, RAF_data)
+                sources.append(JoinSource(RAF_data, how="inner"))
+        self.data_to_model = self._compact(join_on_member_sk(self.data_to_model, sources))
 
+    @instrumented_stage
     def adjust_eligibility(self, include_RAF_analysis=True):
         if len(glob(self.clinical_data_path + "/*eligibility*")) > 0:
-            eligibility_data = my_read_csv(self.clinical_data_path, namePart="eligibility")
-            eligibility_data['Year'] = pd.to_datetime(eligibility_data['YEARMONTH']).year
-            eligibility_data['NumericMonth'] = pd.to_datetime(eligibility_data['YEARMONTH']).month
-            eligibility_data['NumericQuarter'] = round(eligibility_data['NumericMonth'] / 4)
-            eligibility_data['Quarter'] = eligibility_data['NumericQuarter'].apply(lambda x: "Q"+str(x))
-            eligibility_data_year = eligibility_data.pivot_table(index=["MEMBER_SK"],
-                                                           columns=["Year"],
-                                                           aggfunc=sum, values=["ELIGIBLE"])
-            eligibility_data_year.columns = ["Eligibility" + i for i in eligibility_data_year.columns]
-            self.data_to_model = pd.merge(self.data_to_model, eligibility_data_year)
-            eligibility_data_quarter = eligibility_data.pivot_table(index=["MEMBER_SK"],
-                                                                 columns=["Year", "Quarter"],
-                                                                 aggfunc=sum, values=["ELIGIBLE"])
-            eligibility_data_quarter.columns = ["Eligibility" + i for i in eligibility_data_quarter.columns]
-            self.data_to_model = pd.merge(self.data_to_model, eligibility_data_quarter)
-            eligibility_data_month = eligibility_data.pivot_table(index=["MEMBER_SK"],
-                                                                    columns=["Year", "NumericMonth"],
-                                                                    aggfunc=sum, values=["ELIGIBLE"])
-            eligibility_data_month.columns = ["Eligibility" + i for i in eligibility_data_month.columns]
-            self.data_to_model = pd.merge(self.data_to_model, eligibility_data_month)
-
-            for year in self.claims_data_years:
+            eligibility_data = self._read_csv(self.clinical_data_path, my_read_csv, namePart="eligibility")
+            dates = pd.to_datetime(eligibility_data['YEARMONTH'])
+            eligibility_data['Year'] = dates.dt.year
+            eligibility_data['NumericMonth'] = dates.dt.month
+            # Pivot once by month, the yearly and quarterly eligibilities are sums of its columns
+            eligibility_data_month = eligibility_data.pivot_table(index="MEMBER_SK",
+                                                                  columns=["Year", "NumericMonth"],
+                                                                  aggfunc="sum", values="ELIGIBLE")
+            years = eligibility_data_month.columns.get_level_values("Year")
+            months = eligibility_data_month.columns.get_level_values("NumericMonth")
+            quarters = (months - 1) // 3 + 1
+            eligibility_data_year = eligibility_data_month.T.groupby(years).sum(min_count=1).T
+            eligibility_data_year.columns = [f"Eligibility {i}" for i in eligibility_data_year.columns]
+            eligibility_data_quarter = eligibility_data_month.T.groupby([years, quarters]).sum(min_count=1).T
+            eligibility_data_quarter.columns = [f"Eligibility {i}_Q{j}" for i, j in eligibility_data_quarter.columns]
+            eligibility_data_month.columns = [f"Eligibility {i}_{j}" for i, j in eligibility_data_month.columns]
+            eligibility = pd.concat([eligibility_data_year, eligibility_data_quarter, eligibility_data_month], axis=1)
+            self.data_to_model = join_on_member_sk(self.data_to_model,
+                                                   [JoinSource(eligibility.reset_index(), how="inner")])
+
+            years = [year for year in self.claims_data_years if f"Eligibility {year}" in self.data_to_model.columns]
+            column_groups = eligibility_column_groups(self.data_to_model.columns, years)
+            adjusted = {}
+            for year in years:
                 print(f"Claim year: {year}")
-                not_eligible_indices = self.data_to_model[(self.data_to_model[f"Eligibility {year}"].isnull()) | \
-                                                         (self.data_to_model[f"Eligibility {year}"] <= 1)].index
-                # TODO: Verify this regex
-                yearly_column_headers = self.data_to_model.columns[
-                                        self.data_to_model.columns.str.contain("^(Claims |Category *)" + str(year)) &
-                                        ~self.data_to_model.columns.str.contain("_Q[1-4]")]
-                self.data_to_model[yearly_column_headers] = self.data_to_model[yearly_column_headers] * \
-                                                            (12 / self.data_to_model["Eligibility " +str(year)])
-                self.data_to_model.loc[not_eligible_indices, yearly_column_headers] = None
+                columns = column_groups[year]
+                eligibility_year = self.data_to_model[f"Eligibility {year}"].to_numpy(dtype=float)
+                not_eligible = np.isnan(eligibility_year) | (eligibility_year <= 1)
+
+                # Claims are scaled to 12 months of eligibility, and unknown when not eligible
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    block = self.data_to_model[columns["claims"]].to_numpy(dtype=float) * \
+                        (12 / eligibility_year)[:, None]
+                block[not_eligible] = np.nan
+                adjusted.update(zip(columns["claims"], block.T))
 
                 if include_RAF_analysis:
-                    yearly_column_headers = self.data_to_model.columns[
-                                        self.data_to_model.columns.str.contain("^(RAF |RAF_nonDemog *)" + str(year)) &
-                                        ~self.data_to_model.columns.str.contain("_Q[1-4]")]
-                    self.data_to_model.loc[not_eligible_indices, yearly_column_headers] = None
+                    block = self.data_to_model[columns["RAF"]].to_numpy(dtype=float, copy=True)
+                    block[not_eligible] = np.nan
+                    adjusted.update(zip(columns["RAF"], block.T))
 
                 # |--- |--- |--- Statuses ----
-                yearly_column_headers = self.data_to_model.columns[
-                    self.data_to_model.columns.str.contain("^Status0 " + str(year)) &
-                    ~self.data_to_model.columns.str.contain("_Q[1-4]")]
-                self.data_to_model.loc[not_eligible_indices, yearly_column_headers] = \
-                    fx.set_zero_to_na(self.data_to_model.loc[not_eligible_indices, yearly_column_headers])
-
-                for quarter in range(1,5):
-                    not_eligible_indices = self.data_to_model[(self.data_to_model[f"Eligibility {year}_Q{quarter}"].isnull()) | \
-                                                         (self.data_to_model[f"Eligibility {year}_Q{quarter}"] == 0)].index
-                    not_enough_data_indices = self.data_to_model[(self.data_to_model[f"Eligibility {year}_Q{quarter}"]>0)
-                                                        & (self.data_to_model[f"Eligibility {year}_Q{quarter}"]<2)].index
-                    quarterly_column_headers = self.data_to_model.columns[self.data_to_model.columns.str.contain("^Claims " + str(year)) &
-                    self.data_to_model.columns.str.contain("_Q[1-4]")]
-                    self.data_to_model.loc[not_eligible_indices, quarterly_column_headers] = \
-                        fx.set_zero_to_na(self.data_to_model.loc[not_eligible_indices, quarterly_column_headers])
-                    self.data_to_model.loc[not_enough_data_indices, quarterly_column_headers] = \
-                        fx.set_zero_to_na(self.data_to_model.loc[not_enough_data_indices, quarterly_column_headers])
+                block = self.data_to_model[columns["status"]].to_numpy(dtype=float, copy=True)
+                set_zero_to_na_rows(block, not_eligible)
+                adjusted.update(zip(columns["status"], block.T))
+
+                # The quarterly claims of the year are unknown where zero, for the members
+                # with any quarter without (or with less than two months of) eligibility
+                not_eligible_quarter = np.zeros(len(self.data_to_model), dtype=bool)
+                for quarter in range(1, 5):
+                    eligibility_quarter = self.data_to_model[f"Eligibility {year}_Q{quarter}"].to_numpy(dtype=float)
+                    not_eligible_quarter |= np.isnan(eligibility_quarter) | (eligibility_quarter == 0) | \
+                        ((eligibility_quarter > 0) & (eligibility_quarter < 2))
+                block = self.data_to_model[columns["quarterly_claims"]].to_numpy(dtype=float, copy=True)
+                set_zero_to_na_rows(block, not_eligible_quarter)
+                adjusted.update(zip(columns["quarterly_claims"], block.T))
+            if adjusted:
+                self.data_to_model[list(adjusted)] = pd.DataFrame(adjusted, index=self.data_to_model.index)
+            self.data_to_model = self._compact(self.data_to_model)
         return self
 
+    @instrumented_stage
     def aggregate_adjusted_ORs(self):
-        file_dir = os.path.join(self.during_analysis_data_path, "augmentedORs/hierarchial/mergedHierarchialData/")
-        diseases_to_study = re.sub("(InterventionData_|.csv)", "", glob(file_dir+".csv"))
-        for disease_to_study in diseases_to_study:
-            BH_data = pd.read_csv(disease_to_study)
+        for file_name in self._adjusted_OR_files():
+            disease_to_study = re.sub("(InterventionData_|.csv)", "", os.path.basename(file_name))
+            BH_data = self._read_csv(file_name)
             BH_data.index.rename("MEMBER_SK", inplace=True)
             BH_data.columns = [f"BH-H{self.prediction_year - 1}{disease_to_study}{i}" for i in BH_data.columns]
             self.data_to_model = pd.merge(self.data_to_model, BH_data)
+        self.data_to_model = self._compact(self.data_to_model)
         return self
 
+    @instrumented_stage
     def aggregate_clinical_data(self):
         if len(glob(self.clinical_data_path + "*clinics*.csv") > 0):
-            clinic_data = my_read_csv(os.path.join(self.clinical_data_path, namePart="clinic"))
+            clinic_data = self._read_csv(os.path.join(self.clinical_data_path, namePart="clinic"), my_read_csv)
             clinic_data = clinic_data[["MEMBER_SK", "POVIDER_NAME", "PROVIDER_OFFICE_NAME", "PROVIDER_NETWORK"]]
-            self.data_to_model = pd.merge(self.data_to_model, clinic_data)
+            self.data_to_model = self._compact(pd.merge(self.data_to_model, clinic_data))
+        return self
+
+    def run(self, include_RAF=True):
+        self.process_lab_data()
+        self.aggregate_claims(include_RAF=include_RAF)
+        self.adjust_eligibility(include_RAF_analysis=include_RAF)
+        self.aggregate_adjusted_ORs()
+        self.aggregate_clinical_data()
+        return self
+
+    def _stage_state(self):
+        return {"data_to_model": self.data_to_model, "claims_data_years": getattr(self, "claims_data_years", None)}
+
+    def _run_stage(self, step, state=None, **kwargs):
+        # Run one step from the state left by the previous stage and return the new state
+        if state is not None:
+            self.data_to_model = state["data_to_model"]
+            self.claims_data_years = state["claims_data_years"]
+        step(**kwargs)
+        return self._stage_state()
+
+    def run_incremental(self, stage_cache_dir, include_RAF=True):
+        # Like run, but every step is a stage of a StageGraph whose output is cached in
+        # stage_cache_dir, and only the steps whose input files (or earlier outputs) changed
+        # since the last run are recomputed
+        condition_status_files = [path for _, path in self._condition_status_files()]
+        claims_files = [os.path.join(self.claims_based_data_path, claims_file) for claims_file in CLAIMS_FILES] + \
+            [os.path.join(preDeterminedDataPath, "diseaseStatistics/diseasesData.csv"),
+             os.path.join(self.claims_based_data_path, "diseaseStatusYear.csv")] + condition_status_files
+        if include_RAF:
+            claims_files += self._RAF_files()
+        stages = StageGraph(stage_cache_dir)
+        stages.add("labs", lambda: self._run_stage(self.process_lab_data),
+                   input_files=[self.raw_RFs_path] + self._lab_files())
+        stages.add("claims", lambda state: self._run_stage(self.aggregate_claims, state, include_RAF=include_RAF),
+                   input_files=claims_files, depends_on=["labs"], params=include_RAF)
+        stages.add("eligibility",
+                   lambda state: self._run_stage(self.adjust_eligibility, state, include_RAF_analysis=include_RAF),
+                   input_files=glob(self.clinical_data_path + "/*eligibility*"), depends_on=["claims"],
+                   params=include_RAF)
+        stages.add("adjusted_ORs", lambda state: self._run_stage(self.aggregate_adjusted_ORs, state),
+                   input_files=self._adjusted_OR_files(), depends_on=["eligibility"])
+        stages.add("clinical", lambda state: self._run_stage(self.aggregate_clinical_data, state),
+                   input_files=glob(self.clinical_data_path + "*clinics*.csv"), depends_on=["adjusted_ORs"])
+        outputs, self.stage_statuses = stages.execute()
+        self.data_to_model = outputs["clinical"]["data_to_model"]
+        self.claims_data_years = outputs["clinical"]["claims_data_years"]
         return self
 
-    def save_aggregate_data(self, write=True):
+    def save_aggregate_data(self, write=True, output_format="csv", partition_by=None, workers=1):
+        # output_format "csv" writes aggregatedData.csv (formatted in `workers` threads when
+        # more than one), "parquet" writes aggregatedData.parquet, a single file or a directory
+        # partitioned by column group or member bucket (see aggregation_output.write_parquet)
         if write:
-            self.data_to_model.to_csv(os.path.join(self.aggregated_data_path, "aggregatedData.csv"))
+            with self.metrics.stage("save_aggregate_data") as metrics:
+                metrics["rows_in"], metrics["columns_in"] = self.data_to_model.shape
+                if output_format == "csv" and workers > 1:
+                    write_csv_threaded(self.data_to_model, os.path.join(self.aggregated_data_path, "aggregatedData.csv"),
+                                       workers=workers)
+                elif output_format == "csv":
+                    self.data_to_model.to_csv(os.path.join(self.aggregated_data_path, "aggregatedData.csv"))
+                elif output_format == "parquet":
+                    write_parquet(self.data_to_model, os.path.join(self.aggregated_data_path, "aggregatedData.parquet"),
+                                  partition_by=partition_by)
+                else:
+                    raise NotImplementedError(f"BASEHEALTH: output format {output_format} is not supported")
+            self.write_run_report()
+
+    def write_run_report(self):
+        for metrics in self.metrics.stages:
+            if metrics["stage"] == "load_sources":
+                metrics["load_times"] = self.load_times
+        self.metrics.write(os.path.join(self.aggregated_data_path, "aggregatedDataReport.json"))
+        if self.metrics.profiler is not None:
+            self.metrics.dump_profile(os.path.join(self.aggregated_data_path, "aggregatedDataProfile.prof"))
 
 
 
@@ -0,0 +1,41 @@
+import os
+import sys
+import argparse
+import analyze_barcodes as ab
+from barcode_count_files import merge_count_files
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        prog='barcode_merge',
+        description='Merge the binary barcode count files of several runs or lanes, then '
+                    'merge barcodes with one mismatch and summarize the combined counts once')
+    required_counts = parser.add_argument_group('Required arguments')
+    required_counts.add_argument('--count_files', nargs='+', required=True,
+                                 help='Binary count files written by barcode_analysis --counts_file')
+    parser.add_argument('-o', '--output_path', help='Location of output file path')
+    parser.add_argument('--collapse_method', choices=sorted(ab.COLLAPSE_METHODS), default='index',
+                        help='Method used to merge barcodes with one mismatch default: index')
+    parser.add_argument('--output_format', choices=['csv', 'parquet'], default='csv',
+                        help='Format of the barcode frequencies file default: csv')
+
+    args = parser.parse_args()
+    print(f"Merging {len(args.count_files)} count files...\n\n")
+    header, fow, rev = merge_count_files(args.count_files)
+    print(f"Merging barcodes with one mismatch (tags {header['tags'][0]}, {header['tags'][1]})...\n\n")
+    collapse_barcodes = ab.COLLAPSE_METHODS[args.collapse_method]
+    fow = collapse_barcodes(fow)
+    rev = collapse_barcodes(rev)
+    print("Writing counts to file...\n\n")
+    output_data = ab.summarize_barcodes(fow, rev)
+    output_file = ab.write_barcode_summary(output_data, args.output_path or os.getcwd(), args.output_format)
+    print(f"\n\nComplete: {output_file}\n")
+
+
+if __name__ == '__main__':
+    # Check for python v3.5+
+    if not sys.version_info >= (3, 5):
+        print("Please update your python to 3.5 or higher")
+        exit()
+    main()
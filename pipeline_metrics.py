@@ -0,0 +1,185 @@
+import os
+import csv
+import sys
+import json
+import time
+import cProfile
+import functools
+import threading
+import contextlib
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then not reported
+    resource = None
+
+
+def _peak_rss_bytes():
+    """
+    :return: peak resident set size of this process so far, in bytes
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def _current_rss_bytes():
+    """
+    :return: resident set size of this process now, in bytes, or None where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class _RssSampler(object):
+    """Sample the RSS of this process in a background thread, keeping the highest sample"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.start_rss = _current_rss_bytes()
+        self.peak_rss = self.start_rss
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, _current_rss_bytes())
+
+    def start(self):
+        if self.start_rss is not None:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        :return: highest RSS sampled since `start`, in bytes, or None where it cannot be sampled
+        """
+        if self.start_rss is None:
+            return None
+        self._stopped.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, _current_rss_bytes())
+        return self.peak_rss
+
+
+def _children_cpu_seconds():
+    """
+    :return: CPU time used by terminated child processes (e.g. worker pools)
+    """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class PipelineMetrics(object):
+    """Record wall time, CPU time, peak RSS and counters of each pipeline stage"""
+
+    def __init__(self, profile=False, profile_stage=None, profiler_hook=None, rss_sample_interval=0.01):
+        """
+        :param profile: run cProfile during the stages
+        :param profile_stage: only profile the stage with this name
+        :param profiler_hook: function taking a stage name and returning a context manager
+            entered around the profiled stages (e.g. to attach another profiler)
+        :param rss_sample_interval: seconds between samples of the RSS during a stage
+        """
+        self.stages = []
+        self.rss_sample_interval = rss_sample_interval
+        self.profiler = cProfile.Profile() if profile else None
+        self.profile_stage = profile_stage
+        self.profiler_hook = profiler_hook
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure the code run inside the `with` block as one stage.
+        Counters can be added to the yielded dictionary inside the block.
+        :param name: name of the stage
+        :return: dictionary of the stage's metrics
+        """
+        metrics = {'stage': name}
+        profiled = self.profile_stage is None or self.profile_stage == name
+        rss_sampler = _RssSampler(self.rss_sample_interval).start()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time() + _children_cpu_seconds()
+        with contextlib.ExitStack() as profilers:
+            if profiled and self.profiler_hook is not None:
+                profilers.enter_context(self.profiler_hook(name))
+            if profiled and self.profiler is not None:
+                self.profiler.enable()
+                profilers.callback(self.profiler.disable)
+            try:
+                yield metrics
+            finally:
+                profilers.close()
+                peak_rss_stage = rss_sampler.stop()
+                metrics['wall_seconds'] = time.perf_counter() - wall_start
+                metrics['cpu_seconds'] = time.process_time() + _children_cpu_seconds() - cpu_start
+                metrics['peak_rss_bytes'] = _peak_rss_bytes()
+                # Highest RSS sampled during the stage above the RSS it started with, also
+                # when the stage peaks below an earlier stage (unlike the process high-water mark)
+                if peak_rss_stage is not None:
+                    metrics['peak_rss_delta_bytes'] = peak_rss_stage - rss_sampler.start_rss
+                if metrics.get('reads_processed') is not None and metrics['wall_seconds'] > 0:
+                    metrics['reads_per_second'] = metrics['reads_processed'] / metrics['wall_seconds']
+                self.stages.append(metrics)
+
+    @property
+    def elapsed_seconds(self):
+        return time.perf_counter() - self._start
+
+    def write(self, metrics_file):
+        """
+        Write the stage metrics to a JSON file, or a CSV file with one row per stage
+        :param metrics_file: output path, ending with `.json` or `.csv`
+        """
+        if metrics_file.endswith('.csv'):
+            columns = []
+            for metrics in self.stages:
+                columns += [k for k in metrics if k not in columns]
+            with open(metrics_file, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=columns)
+                writer.writeheader()
+                writer.writerows(self.stages)
+        elif metrics_file.endswith('.json'):
+            with open(metrics_file, 'w') as f:
+                json.dump({'total_wall_seconds': self.elapsed_seconds, 'peak_rss_bytes': _peak_rss_bytes(),
+                           'pid': os.getpid(), 'stages': self.stages}, f, indent=2)
+        else:
+            raise NotImplementedError("Metrics file format not supported")
+
+    def dump_profile(self, profile_file):
+        """
+        Write the cProfile statistics of all stages, readable with `pstats`
+        :param profile_file: output path
+        """
+        if self.profiler is None:
+            raise ValueError("Profiling was not enabled for these metrics.")
+        self.profiler.dump_stats(profile_file)
+
+
+def instrumented_stage(step):
+    """
+    Decorator recording a method as a stage of `self.metrics`, named after the method,
+    with the shape of `self.data_to_model` before and after when the object has one
+    :param step: method to instrument
+    :return: instrumented method
+    """
+    @functools.wraps(step)
+    def instrumented_step(self, *args, **kwargs):
+        with self.metrics.stage(step.__name__) as metrics:
+            data_to_model = getattr(self, "data_to_model", None)
+            if data_to_model is not None:
+                metrics["rows_in"], metrics["columns_in"] = data_to_model.shape
+            result = step(self, *args, **kwargs)
+            data_to_model = getattr(self, "data_to_model", None)
+            if data_to_model is not None:
+                metrics["rows_out"], metrics["columns_out"] = data_to_model.shape
+        return result
+    return instrumented_step
@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import time
+import uuid
+import pickle
+import hashlib
+import threading
+
+import pandas as pd
+
+# Single-quoted SQL literals, which are left as they are when normalizing a query
+_SQL_LITERAL = re.compile(r"('(?:[^']|'')*')")
+
+
+def normalize_sql(query):
+    """
+    Normalize a query so that formatting differences map to the same cache entry:
+    whitespace outside string literals is collapsed and a trailing semicolon dropped
+    :param query: SQL query
+    :return: normalized query
+    """
+    parts = _SQL_LITERAL.split(query)
+    parts = [part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts)]
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+class QueryCache(object):
+    """
+    On-disk cache of query results as Parquet files (pickle for frames Parquet cannot
+    store), keyed by server, normalized query and parameters. Entries expire after their
+    time to live, and the least recently used entries are evicted beyond max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 ** 30, default_ttl=3600):
+        """
+        :param cache_dir: directory of the cached results
+        :param max_bytes: size of the cache on disk above which entries are evicted
+        :param default_ttl: seconds a result stays valid when the query sets no ttl
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, srv, query, params):
+        key = json.dumps([srv, normalize_sql(query), repr(params)])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _entry_files(self, key):
+        return [os.path.join(self.cache_dir, key + suffix) for suffix in ('.json', '.parquet', '.pkl')]
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, srv, query, params=None, ttl=None):
+        """
+        :param ttl: maximum age in seconds of a result to reuse, default: the ttl it was stored with
+        :return: cached result DataFrame, or None when missing or expired
+        """
+        metadata_file, parquet_file, pickle_file = self._entry_files(self._key(srv, query, params))
+        try:
+            with open(metadata_file) as f:
+                metadata = json.load(f)
+            max_age = metadata['ttl'] if ttl is None else min(metadata['ttl'], ttl)
+            if time.time() > metadata['created'] + max_age:
+                self._remove(metadata_file, parquet_file, pickle_file)
+                self._count(False)
+                return None
+            # Mark as recently used for eviction
+            os.utime(metadata_file)
+            if metadata['format'] == 'parquet':
+                data = pd.read_parquet(parquet_file)
+            else:
+                with open(pickle_file, 'rb') as f:
+                    data = pickle.load(f)
+        except (FileNotFoundError, ValueError, KeyError):
+            # Missing, or removed by another thread or process meanwhile
+            self._count(False)
+            return None
+        self._count(True)
+        return data
+
+    def put(self, srv, query, data, params=None, ttl=None):
+        """
+        :param data: result DataFrame to cache
+        :param ttl: seconds the result stays valid, default: default_ttl
+        """
+        key = self._key(srv, query, params)
+        metadata_file, parquet_file, pickle_file = self._entry_files(key)
+        temporary_file = os.path.join(self.cache_dir, '{}.{}.tmp'.format(key, uuid.uuid4().hex))
+        try:
+            data.to_parquet(temporary_file)
+            os.replace(temporary_file, parquet_file)
+            data_format = 'parquet'
+        except (ValueError, TypeError, ImportError):
+            with open(temporary_file, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_file, pickle_file)
+            data_format = 'pickle'
+        # The metadata is written last, an entry without it is never read
+        with open(temporary_file, 'w') as f:
+            json.dump({'srv': srv, 'query': normalize_sql(query), 'params': repr(params), 'format': data_format,
+                       'created': time.time(), 'ttl': self.default_ttl if ttl is None else ttl}, f)
+        os.replace(temporary_file, metadata_file)
+        self.evict()
+
+    def get_or_fetch(self, srv, query, fetch, params=None, ttl=None):
+        """
+        :param fetch: function running the query and returning its result DataFrame
+        :param ttl: maximum age in seconds of a cached result to reuse, and time to live of a new one
+        :return: cached result, or the result of `fetch`, which is then cached
+        """
+        data = self.get(srv, query, params, ttl)
+        if data is None:
+            data = fetch()
+            self.put(srv, query, data, params, ttl)
+        return data
+
+    def _remove(self, *files):
+        for file_path in files:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, srv=None, query=None, params=None):
+        """
+        Remove the entry of one query, all the entries of a server, or everything
+        :param srv: server of the entries to remove, default: all servers
+        :param query: query to remove (with its params), default: all queries
+        """
+        if query is not None:
+            self._remove(*self._entry_files(self._key(srv, query, params)))
+            return
+        for entry in os.listdir(self.cache_dir):
+            if not entry.endswith('.json'):
+                continue
+            key = entry[:-len('.json')]
+            if srv is not None:
+                try:
+                    with open(os.path.join(self.cache_dir, entry)) as f:
+                        if json.load(f)['srv'] != srv:
+                            continue
+                except (FileNotFoundError, ValueError, KeyError):
+                    pass
+            self._remove(*self._entry_files(key))
+
+    def evict(self):
+        # Entries by last use (the metadata file's modification time), newest first
+        entries = {}
+        for entry in os.listdir(self.cache_dir):
+            if entry.endswith('.tmp'):
+                continue
+            key, suffix = os.path.splitext(entry)
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, entry))
+            except FileNotFoundError:
+                continue
+            last_used, size = entries.get(key, (0, 0))
+            entries[key] = (stat.st_mtime if suffix == '.json' else last_used, size + stat.st_size)
+        total_bytes = 0
+        for key, (_, size) in sorted(entries.items(), key=lambda entry: entry[1][0], reverse=True):
+            total_bytes += size
+            if total_bytes > self.max_bytes:
+                self._remove(*self._entry_files(key))
+
+    @property
+    def stats(self):
+        """
+        :return: dictionary of the numbers of hits and misses, entries and bytes on disk
+        """
+        files = [os.path.join(self.cache_dir, i) for i in os.listdir(self.cache_dir) if not i.endswith('.tmp')]
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': sum(i.endswith('.json') for i in files),
+                'bytes': sum(os.path.getsize(i) for i in files if os.path.exists(i))}